@@ -0,0 +1,327 @@
+"""
+Annotates many gene lists in a process pool.
+
+The gene lists are read one at a time from a directory with one list per
+file, a GMT file, a CSV file with one list per column, a long format CSV
+file with list_id,gene rows or a JSON lines file. The index is loaded
+once. Where processes are forked the workers share the loaded index copy
+on write, otherwise each worker loads the index once.
+
+The results are written in input order as the lists complete: into one
+file per list in an output directory, or into a single CSV or JSON lines
+file. Only a bounded number of lists are in flight at any time.
+"""
+import csv
+import functools
+import json
+import multiprocessing
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from pathlib import Path
+
+from genescape import gs_graph, utils
+
+# The index used by the workers.
+WORKER = dict(idg=None)
+
+# The name of the summary file in the output directory.
+SUMMARY = "batch.csv"
+
+# The columns of the summary file.
+COLUMNS = ["name", "genes", "coverage", "nodes", "edges", "seconds", "errors"]
+
+# The columns of the annotations.
+TERMS = ["Coverage", "Function", "Domain", "GO", "Genes"]
+
+# The names of the list column in the long format.
+LIST_IDS = ("list_id", "list", "name")
+
+# The number of lists in flight per worker.
+WINDOW = 4
+
+
+def clean(genes):
+    """
+    Strips the genes, drops the empty and commented ones.
+    """
+    genes = map(lambda x: x.strip(), genes)
+    genes = filter(lambda x: x and not x.startswith("#"), genes)
+    return list(genes)
+
+
+def read_dir(path):
+    """
+    Yields the gene lists of the files in a directory, named by the files.
+    """
+    for fname in sorted(Path(path).iterdir()):
+        if fname.is_file() and not fname.name.startswith("."):
+            stream = utils.get_stream(str(fname))
+            yield fname.name.split(".")[0], clean(row[0] for row in csv.reader(stream) if row)
+
+
+def read_gmt(fname):
+    """
+    Yields the gene sets of a GMT file: a name, a description then the genes, tab separated.
+    """
+    for line in utils.get_stream(fname):
+        row = line.split("\t")
+        if len(row) > 2:
+            yield row[0], clean(row[2:])
+
+
+def read_csv(fname):
+    """
+    Yields the gene lists of a CSV file.
+
+    A file with a list_id,gene header is in long format, the rows of a
+    list must be adjacent. Other files hold one list per column, named by
+    the header.
+    """
+    stream = utils.get_stream(fname)
+    delimiter = "\t" if fname.endswith((".tsv", ".tsv.gz")) else ","
+    reader = csv.reader(stream, delimiter=delimiter)
+    header = next(reader, [])
+
+    # The long format is read one list at a time.
+    if len(header) == 2 and header[0].strip().lower() in LIST_IDS:
+        for name, rows in groupby(filter(lambda x: len(x) > 1, reader), key=lambda x: x[0]):
+            yield name.strip(), clean(row[1] for row in rows)
+        return
+
+    # The columns are only complete at the end of the file.
+    columns = [[] for _ in header]
+    for num, row in enumerate(reader, start=2):
+        if any(row[len(header):]):
+            utils.stop(f"{fname}: row {num} has more values than the header")
+        for pos, value in enumerate(row[:len(header)]):
+            columns[pos].append(value)
+    for pos, name in enumerate(header):
+        yield name.strip(), clean(columns[pos])
+
+
+def read_jsonl(fname):
+    """
+    Yields the gene lists of a JSON lines file, one {"name": ..., "genes": [...]} object per line.
+    """
+    for line in utils.get_stream(fname):
+        data = json.loads(line)
+        yield str(data["name"]), clean(data["genes"])
+
+
+def read_lists(fname, unique=True):
+    """
+    Yields the named gene lists of an input. The names are made unique when they name files.
+    """
+    if Path(fname).is_dir():
+        stream = read_dir(fname)
+    elif fname.endswith((".gmt", ".gmt.gz")):
+        stream = read_gmt(fname)
+    elif fname.endswith((".jsonl", ".jsonl.gz")):
+        stream = read_jsonl(fname)
+    else:
+        stream = read_csv(fname)
+
+    if not unique:
+        yield from stream
+        return
+
+    seen = dict()
+    for key, genes in stream:
+        name = re.sub(r"[^\w.-]+", "_", key) or "list"
+        count = seen[name] = seen.get(name, 0) + 1
+        if count > 1:
+            name = f"{name}_{count}"
+        yield name, genes
+
+
+class DirWriter:
+    """
+    Writes the summary of the lists, the workers write the files of each list.
+    """
+
+    def __init__(self, path):
+        self.path = self.out_dir = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.summary = self.path / SUMMARY
+        self.fp = open(self.summary, "w", newline="")
+        self.writer = csv.DictWriter(self.fp, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, result):
+        row, _ = result
+        self.writer.writerow(row)
+
+    def close(self):
+        self.fp.close()
+
+
+class CsvWriter(DirWriter):
+    """
+    Writes the annotations of all lists into a single CSV file, the first column names the list.
+    """
+
+    def __init__(self, path):
+        self.path, self.out_dir = Path(path), None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.summary = self.path.with_name(f"{self.path.name.split('.')[0]}.{SUMMARY}")
+        self.fp = open(self.summary, "w", newline="")
+        self.writer = csv.DictWriter(self.fp, fieldnames=COLUMNS)
+        self.writer.writeheader()
+        self.out = open(self.path, "w", newline="")
+        self.terms = csv.writer(self.out)
+        self.terms.writerow(["List"] + TERMS)
+
+    def write(self, result):
+        super().write(result)
+        row, records = result
+        for record in records or []:
+            self.terms.writerow([row["name"]] + [record[key] for key in TERMS])
+
+    def close(self):
+        super().close()
+        self.out.close()
+
+
+class JsonWriter:
+    """
+    Writes one JSON object per list: the summary and the annotations.
+    """
+
+    def __init__(self, path):
+        self.path = self.summary = Path(path)
+        self.out_dir = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fp = open(self.path, "w")
+
+    def write(self, result):
+        row, records = result
+        data = dict(row, terms=records or [])
+        self.fp.write(json.dumps(data) + "\n")
+
+    def close(self):
+        self.fp.close()
+
+
+def open_writer(out):
+    """
+    Returns the writer for an output: a CSV or a JSON lines file, otherwise a directory.
+    """
+    out = str(out)
+    if out.endswith(".jsonl"):
+        return JsonWriter(out)
+    if out.endswith(".csv"):
+        return CsvWriter(out)
+    return DirWriter(out)
+
+
+def init_worker(idx_fname):
+    """
+    Loads the index in the workers that did not inherit it.
+    """
+    # The workers report through the summary, only warnings are logged.
+    utils.logger.setLevel(utils.WARNING)
+
+    if WORKER["idg"] is None:
+        WORKER["idg"] = gs_graph.load_index_graph(idx_fname)
+
+
+def annotate_list(item, out_dir=None, root=utils.NS_ALL, coverage=0, pattern='', max_nodes=0, max_edges=0,
+                  dot=False):
+    """
+    Annotates one gene list. Returns the row of the summary and the annotations.
+
+    With an output directory the outputs are written here, only the row is returned.
+    """
+    start = time.time()
+
+    name, genes = item
+    row = dict(name=name, genes=len(genes), coverage=0, nodes=0, edges=0)
+    records = None
+
+    try:
+        run, cover = gs_graph.annotate(WORKER["idg"], targets=genes, root=root, coverage=coverage, pattern=pattern,
+                                       max_nodes=max_nodes, max_edges=max_edges)
+
+        if out_dir:
+            with open(Path(out_dir) / f"{name}.csv", "w") as fp:
+                fp.write(run.as_csv())
+        else:
+            records = run.as_rows()
+
+        if dot:
+            pg = run.as_pydot()
+            pg.set_graph_defaults()
+            pg.write_raw(Path(out_dir) / f"{name}.dot")
+
+        row.update(coverage=cover, nodes=run.tree.number_of_nodes(), edges=run.tree.number_of_edges(),
+                   errors="; ".join(run.errors))
+    except Exception as exc:
+        row.update(errors=str(exc))
+
+    row["seconds"] = round(time.time() - start, 3)
+
+    return row, records
+
+
+def run_batch(fname, idx_fname, out, jobs=1, root=utils.NS_ALL, coverage=0, pattern='', max_nodes=0, max_edges=0,
+              dot=False):
+    """
+    Annotates the gene lists of an input in a process pool.
+
+    The lists are read and the results are written as they complete, in input order.
+    """
+    start = time.time()
+
+    writer = open_writer(out)
+    out_dir = writer.out_dir
+    if dot and not out_dir:
+        utils.stop("the --dot option requires an output directory")
+
+    # Load the index before the pool starts, forked workers inherit it.
+    idg = WORKER["idg"] = gs_graph.load_index_graph(idx_fname)
+    utils.info(str(idg.idx))
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+    func = functools.partial(annotate_list, out_dir=out_dir, root=root, coverage=coverage, pattern=pattern,
+                             max_nodes=max_nodes, max_edges=max_edges, dot=dot)
+
+    utils.info(f"annotating {fname} (jobs={jobs})")
+
+    lists = genes = failed = 0
+
+    def emit(future):
+        nonlocal lists, genes, failed
+        row, records = future.result()
+        writer.write((row, records))
+        lists += 1
+        genes += row["genes"]
+        failed += bool(row["errors"])
+
+    # A bounded window of lists in flight, the oldest one is written first.
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=init_worker,
+                             initargs=(idx_fname,)) as pool:
+        for item in read_lists(str(fname), unique=out_dir is not None):
+            pending.append(pool.submit(func, item))
+            if len(pending) >= jobs * WINDOW:
+                emit(pending.popleft())
+        while pending:
+            emit(pending.popleft())
+
+    writer.close()
+
+    # The throughput report.
+    elapsed = time.time() - start
+    rate = lists / elapsed if elapsed else 0
+    utils.info(f"annotated {lists} lists, {genes:,d} genes in {elapsed:.2f} seconds ({rate:.1f} lists/s)")
+    utils.info(f"summary: {writer.summary}")
+
+    if failed:
+        utils.warn(f"{failed} lists reported errors, see the summary")
+
+    return lists
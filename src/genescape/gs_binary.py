@@ -0,0 +1,591 @@
+"""
+A binary, memory-mappable GeneScape index format.
+
+GO ids and gene symbols are integer coded through string tables, the
+symbol <-> GO term associations are stored as CSR style offset/value arrays.
+The file is opened via mmap and the mappings are exposed as read-only views,
+so loading an index does not parse or copy the data.
+
+Layout:
+
+    MAGIC | header offset | header size | sections ... | JSON header
+
+Each section is an 8 byte aligned array. The JSON header at the end of the
+file lists the position, type and length of every section.
+"""
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+
+from genescape import utils
+from genescape.gs_ontology import OntoGraph
+
+# Identifies the binary index format.
+MAGIC = b"GSBIN\x00\x01\x00"
+
+# The preamble: magic, header offset, header size.
+PREAMBLE = struct.Struct("<8sQQ")
+
+# Format version.
+VERSION = 1
+
+# Marks a missing integer entry.
+NONE = 0xFFFFFFFF
+
+# Term flag: the term is present in the ontology.
+IN_OBO = 1
+
+# Section alignment in bytes.
+ALIGN = 8
+
+
+def is_binary(path):
+    """
+    Returns True if the file is a binary index.
+    """
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def uint_array(values=()):
+    """
+    Returns an unsigned 32 bit integer array.
+    """
+    return array("I", values)
+
+
+def int_array(values=()):
+    """
+    Returns a signed 32 bit integer array.
+    """
+    return array("i", values)
+
+
+class StringTable:
+    """
+    A table of strings stored as a single UTF-8 blob with offsets.
+
+    The rank array lists the string positions in sorted order and
+    allows lookups by binary search. Without a rank array the strings
+    must be stored in sorted order.
+    """
+    __slots__ = ("blob", "offs", "rank")
+
+    def __init__(self, blob, offs, rank=None):
+        self.blob = blob
+        self.offs = offs
+        self.rank = rank
+
+    def __len__(self):
+        return len(self.offs) - 1
+
+    def __getitem__(self, pos):
+        return str(self.blob[self.offs[pos]:self.offs[pos + 1]], "utf-8")
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self[pos]
+
+    def key(self, pos):
+        return bytes(self.blob[self.offs[pos]:self.offs[pos + 1]])
+
+    def get(self, text, default=None):
+        """
+        Returns the position of a string in the table.
+        """
+        target = text.encode("utf-8")
+        rank = self.rank if self.rank is not None else range(len(self))
+        lo, hi = 0, len(rank)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(rank[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(rank) and self.key(rank[lo]) == target:
+            return rank[lo]
+        return default
+
+    def __contains__(self, text):
+        return self.get(text) is not None
+
+
+def string_table(strings, ranked=True):
+    """
+    Encodes a list of strings into the blob, offset and rank arrays.
+    """
+    encoded = [text.encode("utf-8") for text in strings]
+    blob = b"".join(encoded)
+    offs = uint_array([0])
+    total = 0
+    for value in encoded:
+        total += len(value)
+        offs.append(total)
+    rank = uint_array(sorted(range(len(encoded)), key=encoded.__getitem__)) if ranked else None
+    return blob, offs, rank
+
+
+class CSRMap(Mapping):
+    """
+    A read-only mapping of strings to lists of strings backed by CSR arrays.
+    """
+
+    def __init__(self, keys, ptr, idx, values, size):
+        self.keys_table = keys
+        self.ptr = ptr
+        self.idx = idx
+        self.values_table = values
+        self.size = size
+
+    def row(self, pos):
+        return self.idx[self.ptr[pos]:self.ptr[pos + 1]]
+
+    def __getitem__(self, key):
+        pos = self.keys_table.get(key)
+        if pos is None or self.ptr[pos] == self.ptr[pos + 1]:
+            raise KeyError(key)
+        values = self.values_table
+        return [values[x] for x in self.row(pos)]
+
+    def __contains__(self, key):
+        pos = self.keys_table.get(key)
+        return pos is not None and self.ptr[pos] != self.ptr[pos + 1]
+
+    def __iter__(self):
+        ptr = self.ptr
+        for pos in range(len(self.keys_table)):
+            if ptr[pos] != ptr[pos + 1]:
+                yield self.keys_table[pos]
+
+    def __len__(self):
+        return self.size
+
+
+class NameMap(Mapping):
+    """
+    A read-only mapping of names to symbols.
+    """
+
+    def __init__(self, syms, target, size):
+        self.syms = syms
+        self.target = target
+        self.size = size
+
+    def __getitem__(self, key):
+        pos = self.syms.get(key)
+        if pos is None or self.target[pos] == NONE:
+            raise KeyError(key)
+        return self.syms[self.target[pos]]
+
+    def __contains__(self, key):
+        pos = self.syms.get(key)
+        return pos is not None and self.target[pos] != NONE
+
+    def __iter__(self):
+        for pos, value in enumerate(self.target):
+            if value != NONE:
+                yield self.syms[pos]
+
+    def __len__(self):
+        return self.size
+
+
+class OboMap(Mapping):
+    """
+    A read-only mapping of GO ids to OBO term dictionaries.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, key):
+        store = self.store
+        pos = store.terms.get(key)
+        if pos is None or not store.flags[pos] & IN_OBO:
+            raise KeyError(key)
+        return store.term(pos)
+
+    def __contains__(self, key):
+        pos = self.store.terms.get(key)
+        return pos is not None and bool(self.store.flags[pos] & IN_OBO)
+
+    def __iter__(self):
+        store = self.store
+        for pos in range(len(store.terms)):
+            if store.flags[pos] & IN_OBO:
+                yield store.terms[pos]
+
+    def __len__(self):
+        return self.store.header["obo_count"]
+
+
+class Store:
+    """
+    Provides access to the sections of a binary index file.
+    """
+
+    def __init__(self, path):
+
+        self.path = Path(path)
+
+        # Map the file into memory.
+        with open(self.path, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, offset, size = PREAMBLE.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            utils.stop(f"not a binary index: {self.path}")
+
+        self.header = json.loads(self.mm[offset:offset + size].decode("utf-8"))
+
+        if self.header.get("version") != VERSION:
+            utils.stop(f"unsupported index version: {self.header.get('version')} in {self.path}")
+
+        # The memory view over the entire file.
+        self.view = memoryview(self.mm)
+
+        # The sections of the file.
+        self.sections = self.header["sections"]
+
+        # Need to swap the bytes if the file was written on a different platform.
+        self.swap = self.header["byteorder"] != sys.byteorder
+
+        # The GO terms.
+        self.terms = StringTable(self.section("term_blob"), self.section("term_offs"), self.section("term_rank"))
+
+        # Flags for each term.
+        self.flags = self.section("term_flags")
+
+        # The name of each term.
+        self.names = StringTable(self.section("name_blob"), self.section("name_offs"))
+
+        # The namespace code for each term.
+        self.ns_codes = self.section("term_ns")
+
+        # The namespace strings.
+        self.ns_names = self.header["namespaces"]
+
+        # The parents of each term.
+        self.isa_ptr = self.section("isa_ptr")
+        self.isa_idx = self.section("isa_idx")
+
+        # The precalculated counts.
+        self.counts = {key: self.section(key) for key in self.header["counts"]}
+
+        # The gene symbols, without a rank array the symbols are stored in sorted order.
+        # Ontology only files have no symbols.
+        self.syms = None
+        if self.has("sym_blob"):
+            rank = self.section("sym_rank") if self.has("sym_rank") else None
+            self.syms = StringTable(self.section("sym_blob"), self.section("sym_offs"), rank)
+
+    def section(self, name):
+        """
+        Returns a typed view of a section.
+        """
+        offset, code, count = self.sections[name]
+        if code == "B":
+            return self.view[offset:offset + count]
+        size = array(code).itemsize
+        view = self.view[offset:offset + count * size]
+        if self.swap:
+            data = array(code, view)
+            data.byteswap()
+            return data
+        return view.cast(code)
+
+    def has(self, name):
+        return name in self.sections
+
+    def term(self, pos):
+        """
+        Returns the OBO dictionary for a term.
+        """
+        parents = self.isa_idx[self.isa_ptr[pos]:self.isa_ptr[pos + 1]]
+        term = {
+            "id": self.terms[pos],
+            "name": self.names[pos],
+            "namespace": self.ns_names[self.ns_codes[pos]],
+        }
+        if len(parents):
+            term["is_a"] = [self.terms[x] for x in parents]
+        for key, values in self.counts.items():
+            term[key] = values[pos]
+        return term
+
+    def data(self):
+        """
+        Returns the index data as read-only views.
+        """
+        from genescape.gs_index import Index
+
+        sizes = self.header["sizes"]
+        data = {
+            Index.INFO_KEY: self.header["info"],
+            Index.OBO_KEY: OboMap(self),
+            Index.SYM2GO: CSRMap(self.syms, self.section("sym2go_ptr"), self.section("sym2go_idx"), self.terms,
+                                 size=sizes[Index.SYM2GO]),
+            Index.GO2SYM: CSRMap(self.terms, self.section("go2sym_ptr"), self.section("go2sym_idx"), self.syms,
+                                 size=sizes[Index.GO2SYM]),
+            Index.NAME2SYM: NameMap(self.syms, self.section("name2sym"), size=sizes[Index.NAME2SYM]),
+        }
+        return data
+
+
+class Writer:
+    """
+    Writes the sections of a binary index file one at a time.
+
+    The sections go to a temporary file next to the target, the file
+    replaces the target when closed. Processes that map the previous file
+    keep reading it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self.fp = open(self.tmp, "wb")
+        self.sections = {}
+
+        # Reserve space for the preamble.
+        self.fp.write(PREAMBLE.pack(MAGIC, 0, 0))
+
+    def pad(self):
+        extra = -self.fp.tell() % ALIGN
+        if extra:
+            self.fp.write(b"\x00" * extra)
+
+    def add(self, name, code, values):
+        """
+        Adds a section from an array or a bytes object.
+        """
+        self.pad()
+        offset = self.fp.tell()
+        if code == "B":
+            data = bytes(values)
+            count = len(data)
+            self.fp.write(data)
+        else:
+            data = values if isinstance(values, array) and values.typecode == code else array(code, values)
+            count = len(data)
+            data.tofile(self.fp)
+        self.sections[name] = [offset, code, count]
+
+    def add_spool(self, name, spool):
+        """
+        Adds a section from the contents of a spool.
+        """
+        spool.flush()
+        self.pad()
+        offset = self.fp.tell()
+        spool.fp.seek(0)
+        shutil.copyfileobj(spool.fp, self.fp, length=1024 * 1024)
+        self.sections[name] = [offset, spool.code, spool.count]
+
+    def close(self, **header):
+        """
+        Writes the header and closes the file.
+        """
+        self.pad()
+        header.update(version=VERSION, byteorder=sys.byteorder, sections=self.sections)
+        text = json.dumps(header).encode("utf-8")
+        offset = self.fp.tell()
+        self.fp.write(text)
+        self.fp.seek(0)
+        self.fp.write(PREAMBLE.pack(MAGIC, offset, len(text)))
+        self.fp.close()
+        os.replace(self.tmp, self.path)
+
+
+class Spool:
+    """
+    Collects the values of a section in a temporary file.
+    """
+
+    # Values buffered in memory before writing to the file.
+    BUFFER = 64 * 1024
+
+    def __init__(self, code, tmpdir=None):
+        self.code = code
+        self.fp = tempfile.TemporaryFile(dir=tmpdir)
+        self.buffer = bytearray() if code == "B" else array(code)
+        self.count = 0
+        # The mappings handed out by view, released on close.
+        self.maps = []
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.BUFFER:
+            self.flush()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= self.BUFFER:
+            self.flush()
+
+    def flush(self):
+        self.count += len(self.buffer)
+        self.fp.write(self.buffer)
+        self.buffer = bytearray() if self.code == "B" else array(self.code)
+        self.fp.flush()
+
+    def view(self):
+        """
+        Returns a typed, memory mapped view of the values written so far.
+        """
+        self.flush()
+        if not self.count:
+            return bytearray() if self.code == "B" else array(self.code)
+        mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        typed = view if self.code == "B" else view.cast(self.code)
+        self.maps.append((mm, view, typed))
+        return typed
+
+    def close(self):
+        """
+        Releases the views, closes the mappings and removes the file.
+        """
+        for mm, view, typed in self.maps:
+            typed.release()
+            view.release()
+            mm.close()
+        self.maps = []
+        self.fp.close()
+
+
+def csr(keys, mapping, lookup):
+    """
+    Encodes a mapping of keys to lists as CSR pointer and index arrays.
+    """
+    ptr, idx = uint_array([0]), uint_array()
+    for key in keys:
+        idx.extend(sorted(set(map(lookup, mapping.get(key, [])))))
+        ptr.append(len(idx))
+    return ptr, idx
+
+
+def write_terms(writer, obo, graph, extra, counts):
+    """
+    Writes the ontology sections: the terms, their attributes, adjacency and ancestors.
+
+    The terms missing from the ontology are placed after the graph nodes.
+    Returns the header fields describing the sections.
+    """
+    terms = list(graph) + list(extra)
+
+    # The namespaces for the terms.
+    namespaces = sorted(set(obo[key].get("namespace", "") for key in graph))
+    ns_pos = {key: pos for pos, key in enumerate(namespaces)}
+
+    blob, offs, rank = string_table(terms)
+    writer.add("term_blob", "B", blob)
+    writer.add("term_offs", "I", offs)
+    writer.add("term_rank", "I", rank)
+    writer.add("term_flags", "B", [IN_OBO] * len(graph) + [0] * len(extra))
+
+    blob, offs, _ = string_table([obo[key].get("name", "") for key in graph] + [""] * len(extra), ranked=False)
+    writer.add("name_blob", "B", blob)
+    writer.add("name_offs", "I", offs)
+    writer.add("term_ns", "B", [ns_pos[obo[key].get("namespace", "")] for key in graph] + [0] * len(extra))
+
+    # The terms missing from the ontology have no parents or children.
+    def pad(ptr):
+        return uint_array(ptr) + uint_array([ptr[-1]] * len(extra))
+
+    # Parents are kept in their original order.
+    writer.add("isa_ptr", "I", pad(graph.parent_ptr))
+    writer.add("isa_idx", "I", graph.parent_idx)
+
+    # The children of each term.
+    writer.add("sub_ptr", "I", pad(graph.child_ptr))
+    writer.add("sub_idx", "I", graph.child_idx)
+
+    # The ancestors of each term.
+    graph.init_closure()
+    writer.add("anc_ptr", "I", pad(graph.anc_ptr))
+    writer.add("anc_idx", "I", graph.anc_idx)
+
+    # The topological order of the terms and their depth.
+    graph.init_order()
+    writer.add("topo", "I", graph.topo)
+    writer.add("depth", "I", uint_array(graph.depths) + uint_array([0] * len(extra)))
+
+    for name in counts:
+        writer.add(name, "i", [obo[key][name] for key in graph] + [0] * len(extra))
+
+    return dict(namespaces=namespaces, counts=counts, obo_count=len(graph))
+
+
+def save_index(idx, path):
+    """
+    Saves an index in the binary format.
+    """
+    obo = idx.obo
+
+    # The ontology graph of the index, includes the ancestors of each term.
+    graph = idx.graph if isinstance(idx.graph, OntoGraph) else OntoGraph.from_obo(obo)
+    graph.init_closure()
+
+    # Terms in ontology order followed by annotated terms missing from the ontology.
+    terms = list(graph)
+    extra = sorted(set(idx.go2sym) - set(terms))
+    terms.extend(extra)
+    term_pos = {key: pos for pos, key in enumerate(terms)}
+
+    # All symbols and names in sorted order.
+    syms = set(idx.sym2go)
+    syms.update(idx.name2sym)
+    syms.update(idx.name2sym.values())
+    for values in idx.go2sym.values():
+        syms.update(values)
+    syms = sorted(syms, key=lambda x: x.encode("utf-8"))
+    sym_pos = {key: pos for pos, key in enumerate(syms)}
+
+    writer = Writer(path)
+
+    # Counts present in the terms.
+    counts = [key for key in (idx.ANNO_COUNT, idx.ANNO_TOTAL, idx.DESC_COUNT) if terms and key in obo[terms[0]]]
+
+    header = write_terms(writer, obo=obo, graph=graph, extra=extra, counts=counts)
+
+    blob, offs, rank = string_table(syms)
+    writer.add("sym_blob", "B", blob)
+    writer.add("sym_offs", "I", offs)
+    writer.add("sym_rank", "I", rank)
+
+    ptr, values = csr(syms, idx.sym2go, term_pos.__getitem__)
+    writer.add("sym2go_ptr", "I", ptr)
+    writer.add("sym2go_idx", "I", values)
+
+    ptr, values = csr(terms, idx.go2sym, sym_pos.__getitem__)
+    writer.add("go2sym_ptr", "I", ptr)
+    writer.add("go2sym_idx", "I", values)
+
+    target = uint_array([NONE] * len(syms))
+    for name, sym in idx.name2sym.items():
+        target[sym_pos[name]] = sym_pos[sym]
+    writer.add("name2sym", "I", target)
+
+    sizes = {idx.SYM2GO: len(idx.sym2go), idx.GO2SYM: len(idx.go2sym), idx.NAME2SYM: len(idx.name2sym)}
+
+    writer.close(info=dict(idx.info), sizes=sizes, **header)
+
+
+def load_index(path):
+    """
+    Opens a binary index via mmap.
+    """
+    from genescape.gs_index import Index
+
+    store = Store(path)
+    idx = Index(data=store.data())
+    idx.store = store
+    return idx
@@ -0,0 +1,319 @@
+"""
+Builds a binary index with bounded memory.
+
+The GAF rows are streamed into sorted runs on disk, the runs are merged
+and the index sections are written incrementally. Only the ontology and
+the sort buffers are kept in memory, the size of the buffers is set by
+the memory budget.
+"""
+import heapq
+import mmap
+import os
+import tempfile
+import time
+from itertools import groupby, tee
+from pathlib import Path
+
+from genescape import gs_binary, gs_obo, utils
+from genescape.gs_binary import NONE, Spool, StringTable, Writer, uint_array
+from genescape.gs_index import Index, build_graph, open_gaf, parse_gaf_header, update_counts
+
+# The default memory budget in megabytes.
+MEMORY = 1024
+
+# The estimated memory used by a buffered record in addition to its text.
+RECORD_SIZE = 80
+
+# The maximal number of runs merged at once.
+FANOUT = 64
+
+
+class Runs:
+    """
+    Collects text records into sorted, deduplicated run files.
+    """
+
+    def __init__(self, tmpdir, budget):
+        self.tmpdir = tmpdir
+        self.budget = budget
+        self.buffer = []
+        self.size = 0
+        self.paths = []
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.size += len(record) + RECORD_SIZE
+        if self.size >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Writes the buffer as a sorted run.
+        """
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        self.paths.append(self.write(dedupe(self.buffer)))
+        self.buffer = []
+        self.size = 0
+
+    def write(self, records):
+        fd, path = tempfile.mkstemp(dir=self.tmpdir, suffix=".run")
+        with os.fdopen(fd, "wt", encoding="utf-8", newline="\n") as fp:
+            fp.writelines(records)
+        return path
+
+    def merge(self):
+        """
+        Returns the sorted, deduplicated records of all runs.
+        """
+        self.spill()
+
+        # Merge in several levels to limit the number of open files.
+        while len(self.paths) > FANOUT:
+            paths, self.paths = self.paths, []
+            for start in range(0, len(paths), FANOUT):
+                group = paths[start:start + FANOUT]
+                self.paths.append(self.write(merge_files(group)))
+                for path in group:
+                    os.remove(path)
+
+        return merge_files(self.paths)
+
+
+def dedupe(records):
+    """
+    Drops the adjacent duplicates of sorted records.
+    """
+    last = None
+    for record in records:
+        if record != last:
+            yield record
+        last = record
+
+
+def merge_files(paths):
+    """
+    Merges sorted run files.
+    """
+    streams = [open(path, encoding="utf-8", newline="\n") for path in paths]
+    try:
+        yield from dedupe(heapq.merge(*streams))
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def split(records):
+    """
+    Splits the records into key, value pairs.
+    """
+    for record in records:
+        key, value = record[:-1].split("\t", 1)
+        yield key, value
+
+
+def stream_gaf(fname, info, sym2go, go2sym, name2sym):
+    """
+    Streams the rows of a GAF file into the runs.
+
+    Returns the GO ids and the number of rows.
+    """
+    handle = open_gaf(fname)
+    stream, header = tee(handle, 2)
+
+    # Parse the headers
+    parse_gaf_header(header, info)
+    info['gaf_fname'] = Path(fname).name
+
+    goids = set()
+    rows = 0
+    for line in stream:
+        if line.startswith("!"):
+            continue
+        row = line.split("\t", 5)
+        if len(row) < 5:
+            continue
+
+        # Convert to uppercase.
+        name, symb, goid = row[1].upper(), row[2].upper(), row[4].upper()
+
+        sym2go.add(f"{symb}\t{goid}\n")
+        sym2go.add(f"{name}\t{goid}\n")
+        go2sym.add(f"{symb}\t{goid}\n")
+
+        # The row number decides the symbol of a name, later rows win.
+        name2sym.add(f"{name}\t{rows:012d}\t{symb}\n")
+
+        goids.add(goid)
+        rows += 1
+
+    handle.close()
+
+    return goids, rows
+
+
+def write_syms(records, term_pos, tmpdir):
+    """
+    Writes the symbols and their GO terms.
+    """
+    spools = dict(sym_blob=Spool("B", tmpdir), sym_offs=Spool("I", tmpdir),
+                  sym2go_ptr=Spool("I", tmpdir), sym2go_idx=Spool("I", tmpdir))
+    for name in ("sym_offs", "sym2go_ptr"):
+        spools[name].append(0)
+
+    offs = direct_count = 0
+    for key, group in groupby(split(records), key=lambda x: x[0]):
+        text = key.encode("utf-8")
+        offs += len(text)
+        spools["sym_blob"].extend(text)
+        spools["sym_offs"].append(offs)
+
+        direct = sorted(term_pos[goid] for _, goid in group)
+        direct_count += len(direct)
+        spools["sym2go_idx"].extend(direct)
+        spools["sym2go_ptr"].append(direct_count)
+
+    return spools
+
+
+def write_go2sym(records, syms, terms, tmpdir):
+    """
+    Writes the symbols of each GO term.
+
+    The records are sorted by symbol, they are counted first then
+    scattered into the rows of the terms.
+    """
+    counts = uint_array([0]) * len(terms)
+    for _, goid in split(records()):
+        counts[terms[goid]] += 1
+
+    ptr = uint_array([0])
+    for value in counts:
+        ptr.append(ptr[-1] + value)
+
+    spool = Spool("I", tmpdir)
+    spool.count = ptr[-1]
+    if spool.count:
+        spool.fp.truncate(spool.count * spool.buffer.itemsize)
+        mm = mmap.mmap(spool.fp.fileno(), 0)
+        target = memoryview(mm).cast("I")
+
+        # Symbols arrive in sorted order, the rows are filled in increasing order.
+        fill = uint_array(ptr[:-1])
+        pos, size = 0, len(syms)
+        for symb, goid in split(records()):
+            while pos < size and syms[pos] != symb:
+                pos += 1
+            term = terms[goid]
+            target[fill[term]] = pos
+            fill[term] += 1
+
+        target.release()
+        mm.close()
+
+    return ptr, counts, spool
+
+
+def write_name2sym(records, syms, tmpdir):
+    """
+    Writes the symbol of each name.
+    """
+    spool = Spool("I", tmpdir)
+    pos, size, count = 0, len(syms), 0
+    for name, group in groupby(split(records), key=lambda x: x[0]):
+
+        # The last row for a name wins.
+        symb = list(group)[-1][1].split("\t", 1)[1]
+        while syms[pos] != name:
+            spool.append(NONE)
+            pos += 1
+        spool.append(syms.get(symb))
+        pos += 1
+        count += 1
+
+    while pos < size:
+        spool.append(NONE)
+        pos += 1
+
+    return spool, count
+
+
+@utils.timer
+def build_index(obo_fname, gaf_fname, fname, mem=MEMORY, tmpdir=None, cache_dir=None):
+    """
+    Builds a binary index from an OBO and GAF file with a bounded memory use.
+    """
+    start = time.time()
+
+    # The ontology is kept in memory.
+    idx = Index()
+    idx = gs_obo.read_obo(obo_fname, idx=idx, cache_dir=cache_dir)
+    obo = idx.obo
+    graph = build_graph(idx)
+    graph.init_closure()
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+
+        # The memory budget is shared by the three sort buffers.
+        budget = mem * 1024 * 1024 // 3
+        sym2go, go2sym, name2sym = Runs(tmp, budget), Runs(tmp, budget), Runs(tmp, budget)
+
+        goids, rows = stream_gaf(gaf_fname, info=idx.info, sym2go=sym2go, go2sym=go2sym, name2sym=name2sym)
+
+        elapsed = time.time() - start
+        rate = rows / elapsed if elapsed else 0
+        runs = len(sym2go.paths) + len(go2sym.paths) + len(name2sym.paths)
+        utils.info(f"gaf: {rows:,d} rows in {elapsed:.2f} seconds ({rate:,.0f} rows/s, runs={runs})")
+
+        # Terms in ontology order followed by annotated terms missing from the ontology.
+        extra = sorted(goids.difference(graph.pos))
+        term_pos = dict(graph.pos)
+        term_pos.update((key, graph.size + pos) for pos, key in enumerate(extra))
+
+        spools = write_syms(sym2go.merge(), term_pos=term_pos, tmpdir=tmp)
+
+        # The symbols are written in sorted order.
+        syms = StringTable(spools["sym_blob"].view(), spools["sym_offs"].view())
+
+        # The go2sym records are read twice, merge them into a single run.
+        path = go2sym.write(go2sym.merge())
+
+        def records():
+            return open(path, encoding="utf-8", newline="\n")
+
+        ptr, counts, spool = write_go2sym(records, syms=syms, terms=term_pos, tmpdir=tmp)
+        spools["go2sym_ptr"] = ptr
+        spools["go2sym_idx"] = spool
+
+        spool, names = write_name2sym(name2sym.merge(), syms=syms, tmpdir=tmp)
+        spools["name2sym"] = spool
+
+        # Fill in annotation counts
+        for node_id in graph:
+            obo[node_id][idx.ANNO_COUNT] = counts[graph.index(node_id)]
+            obo[node_id][idx.ANNO_TOTAL] = counts[graph.index(node_id)]
+        update_counts(idx, graph)
+
+        writer = Writer(fname)
+        header = gs_binary.write_terms(writer, obo=obo, graph=graph, extra=extra,
+                                       counts=[idx.ANNO_COUNT, idx.ANNO_TOTAL, idx.DESC_COUNT])
+
+        for name, value in spools.items():
+            if isinstance(value, Spool):
+                writer.add_spool(name, value)
+            else:
+                writer.add(name, "I", value)
+
+        sizes = {idx.SYM2GO: len(syms), idx.GO2SYM: sum(1 for value in counts if value),
+                 idx.NAME2SYM: names}
+
+        writer.close(info=dict(idx.info), sizes=sizes, **header)
+
+        # The symbol table reads the spool mappings that are closed below.
+        del syms
+        for value in spools.values():
+            if isinstance(value, Spool):
+                value.close()
+
+    return fname
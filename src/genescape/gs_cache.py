@@ -0,0 +1,255 @@
+"""
+Caches the loaded indexes and the results of repeated queries.
+
+The results are kept in a bounded LRU cache, keyed by the identity of the
+index and the normalized query. The least recently used results are
+evicted when either the number of entries or their total size exceeds the
+limits.
+
+The indexes are kept in a cache with a memory budget. Concurrent loads of
+the same index wait for a single load. A reloaded index replaces the
+cached one at once.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from genescape import utils
+
+# The default limits of the cache.
+MAXSIZE = 256
+MAXBYTES = 256 * 1024 * 1024
+
+# The default memory budget of the index cache.
+INDEX_MAXBYTES = int(os.environ.get("GENESCAPE_INDEX_MB", 4096)) * 1024 * 1024
+
+
+class LRUCache:
+    """
+    A thread safe, size bounded least recently used cache.
+    """
+
+    def __init__(self, maxsize=MAXSIZE, maxbytes=MAXBYTES):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """
+        Returns the value for a key and marks it as recently used.
+        """
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes=0):
+        """
+        Stores a value with its size in bytes, evicts the least recently used values over the limits.
+        """
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.data.pop(key)[1]
+            self.data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.data and (len(self.data) > self.maxsize or self.nbytes > self.maxbytes):
+                _, (_, size) = self.data.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        with self.lock:
+            return dict(size=len(self.data), nbytes=self.nbytes, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
+
+    def __str__(self):
+        stats = self.stats()
+        return (f"LRUCache: {stats['size']} entries, {stats['nbytes'] / 1024 / 1024:.1f} MB, "
+                f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+
+
+class Flight:
+    """
+    A load in progress, the other callers wait for its result.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.error = None
+
+
+class IndexCache:
+    """
+    A thread safe cache of loaded indexes with a memory budget.
+
+    Each index is loaded once, callers that ask for an index being loaded
+    wait for that load. The least recently used indexes are evicted when
+    the total size exceeds the budget, the last index is always kept.
+    """
+
+    def __init__(self, maxbytes=INDEX_MAXBYTES):
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.flights = dict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = self.loads = self.waits = self.evictions = self.swaps = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def peek(self, key):
+        """
+        Returns the value for a key without marking it as used, None when missing.
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            return None if entry is None else entry["value"]
+
+    def get(self, key, load, sizeof=lambda value: 0):
+        """
+        Returns the value for a key, loads it when missing.
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry["hits"] += 1
+                self.data.move_to_end(key)
+                return entry["value"]
+
+            flight = self.flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.flights[key] = Flight()
+            else:
+                self.waits += 1
+
+        # Wait for the load of another caller.
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            start = time.time()
+            value = load()
+            elapsed = time.time() - start
+            nbytes = sizeof(value)
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        else:
+            flight.value = value
+            with self.lock:
+                self.data[key] = dict(value=value, nbytes=nbytes, seconds=elapsed, hits=0)
+                self.nbytes += nbytes
+                self.loads += 1
+                self.evict()
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.done.set()
+
+        return value
+
+    def evict(self):
+        """
+        Evicts the least recently used entries over the budget. Call with the lock held.
+        """
+        while len(self.data) > 1 and self.nbytes > self.maxbytes:
+            key, entry = self.data.popitem(last=False)
+            self.nbytes -= entry["nbytes"]
+            self.evictions += 1
+            utils.info(f"evicted: {key} ({entry['nbytes'] / 1024 / 1024:.1f} MB)")
+
+    def swap(self, key, value, nbytes=0, seconds=0):
+        """
+        Replaces the value of a key at once. The callers that hold the old value keep it.
+        """
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry["nbytes"]
+            self.data[key] = dict(value=value, nbytes=nbytes, seconds=seconds, hits=0)
+            self.nbytes += nbytes
+            self.swaps += 1
+            self.evict()
+
+    def pop(self, key):
+        """
+        Removes a key, returns its value or None.
+        """
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return None
+            self.nbytes -= entry["nbytes"]
+            return entry["value"]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache and the size, hits and load time of each entry.
+        """
+        with self.lock:
+            entries = {key: dict(nbytes=entry["nbytes"], hits=entry["hits"], seconds=round(entry["seconds"], 3))
+                       for key, entry in self.data.items()}
+            return dict(size=len(self.data), nbytes=self.nbytes, maxbytes=self.maxbytes, hits=self.hits,
+                        loads=self.loads, waits=self.waits, evictions=self.evictions, swaps=self.swaps,
+                        entries=entries)
+
+    def __str__(self):
+        stats = self.stats()
+        return (f"IndexCache: {stats['size']} indexes, {stats['nbytes'] / 1024 / 1024:.1f} MB, "
+                f"{stats['hits']} hits, {stats['loads']} loads, {stats['evictions']} evictions")
+
+
+def index_identity(fname):
+    """
+    Identifies an index file by its path, modification time and size.
+    """
+    path = Path(fname).resolve()
+    stat = path.stat()
+    return str(path), stat.st_mtime_ns, stat.st_size
+
+
+def query_key(idx_fname, targets, root=utils.NS_ALL, mincount=None, pattern='', identity=None):
+    """
+    Returns the cache key of a query. The targets are normalized as in the runs.
+
+    The identity of the loaded index may be passed, it defaults to the identity of the file.
+    """
+    targets = tuple(sorted(set(map(lambda x: x.strip().upper(), targets))))
+    return identity or index_identity(idx_fname), targets, root, mincount or 0, pattern
@@ -1,42 +1,89 @@
 from genescape import utils, resources
-from genescape import gs_index
-import networkx as nx
-import pandas as pd
-import re, textwrap,random
-import pydot
+from genescape import gs_cache, gs_index
+from genescape.gs_ontology import SubGraph
+import csv, io, re, sys, textwrap,random
+from collections import Counter
 
 ATTR_KEY = 'attr'
 
+# The stages of the pipeline, in order, reported to the progress callbacks.
+STAGE_INDEX, STAGE_SYMBOLS, STAGE_ANCESTORS = "index", "symbols", "ancestors"
+STAGE_PROPAGATION, STAGE_OUTPUT = "propagation", "output"
+STAGES = [STAGE_INDEX, STAGE_SYMBOLS, STAGE_ANCESTORS, STAGE_PROPAGATION, STAGE_OUTPUT]
+
+
+def report(progress, stage):
+    """
+    Calls the progress callback with a stage and the fraction of the pipeline done with it.
+    """
+    if progress is not None:
+        progress(stage, (STAGES.index(stage) + 1) / len(STAGES))
+
+
 class NodeAttr:
     """
     Represents additional attributes for a node in the graph.
+
+    A view into the arrays of a run: sources are bitsets over the input
+    targets, descendants are bitsets over the nodes of the tree.
     """
-    def __init__(self):
-        self.is_input = False
-        self.sources = []
-        self.descendants = []
-        self.sources_all = []
+    __slots__ = ("run", "pos")
+
+    def __init__(self, run, pos):
+        self.run = run
+        self.pos = pos
+
+    @property
+    def is_input(self):
+        return bool(self.run.is_input[self.pos])
+
+    @property
+    def sources(self):
+        return self.run.decode_targets(self.run.src_bits[self.pos])
+
+    @property
+    def sources_all(self):
+        return self.run.decode_targets(self.run.all_bits[self.pos])
+
+    @property
+    def descendants(self):
+        order = self.run.tree.order
+        ids = self.run.graph.ids
+        return set(ids[order[x]] for x in utils.bit_positions(self.run.desc_bits[self.pos]))
 
     @property
     def src_len(self):
-        return len(self.sources)
+        return utils.bit_count(self.run.src_bits[self.pos])
 
     @property
     def src_all_len(self):
-        return len(self.sources_all)
+        return utils.bit_count(self.run.all_bits[self.pos])
 
     @property
     def desc_count(self):
-        return len(self.descendants)
+        return utils.bit_count(self.run.desc_bits[self.pos])
 
-class Run:
+class Session:
+    """
+    The state of a gene list over an index.
+
+    The targets are mapped to GO terms once, together with the ancestors
+    of all annotated terms in sorted and in topological order. Runs with
+    different filters are derived from the same state.
+    """
+
+    # The number of runs kept per session.
+    RUNS = 4
 
-    def __init__(self, idg, targets=[], root=utils.NS_ALL, mincount=1, pattern=''):
+    def __init__(self, idg, targets=[], progress=None, runs=RUNS):
+
+        report(progress, STAGE_SYMBOLS)
 
         # Collects errors
         self.errors = []
 
         # The index object
+        self.idg = idg
         self.idx = idg.idx
 
         self.graph = idg.graph
@@ -78,24 +125,173 @@ class Run:
             msg = f"Missing GO terms: {', '.join(self.missing_goids)}"
             self.errors.append(msg)
 
-        # Nodes to build the subgraph from.
-        self.valid_goids = filter(lambda x: x in self.graph.nodes, self.goids)
+        # Bit positions for the input targets.
+        target_bit = {target: pos for pos, target in enumerate(self.valid_targets)}
+
+        # The input targets of each GO term in the graph as a bitset.
+        self.src = dict()
+        for goid, values in self.go2inp.items():
+            idx = self.graph.index(goid)
+            if idx is not None:
+                bits = 0
+                for target in values:
+                    bits |= 1 << target_bit[target]
+                self.src[idx] = bits
+
+        report(progress, STAGE_ANCESTORS)
+
+        # All nodes a run may contain: the annotated terms and their ancestors.
+        nodes = self.graph.ancestor_union(self.src)
+        nodes.update(self.src)
+
+        # The nodes sorted by GO id and in topological order.
+        self.order = SubGraph(self.graph, nodes).order
+        self.topo = self.graph.topological_order(nodes)
+
+        # The runs of the session by filter, callers that cache the outputs may keep none.
+        self.runs = gs_cache.LRUCache(maxsize=runs)
+
+    def nbytes(self):
+        """
+        Estimates the memory held by the session in bytes, without the kept runs.
+        """
+        size = sum(map(sys.getsizeof, (self.src, self.go2inp, self.goids, self.order, self.topo)))
+        size += sum(map(sys.getsizeof, self.src.values()))
+        size += sum(map(sys.getsizeof, self.go2inp.values()))
+        size += sum(map(sys.getsizeof, self.order)) + sum(map(sys.getsizeof, self.topo))
+        return size
+
+    def select(self, root=utils.NS_ALL, mincount=1, pattern='', errors=None):
+        """
+        Returns the GO terms of the targets that pass the filters.
+        """
+        goids = filter(lambda x: x in self.graph, self.goids)
 
         # Apply the root filter.
         if root != utils.NS_ALL:
-            self.valid_goids = filter(lambda x: self.graph.nodes[x][utils.NAMESPACE] == root, self.valid_goids)
+            goids = filter(lambda x: self.graph.namespace(x) == root, goids)
 
         # Apply the pattern filter.
         if pattern:
             try:
                 patt = re.compile(pattern, re.IGNORECASE)
-                self.valid_goids = filter(lambda x: re.search(patt, self.graph.nodes[x]["name"]), self.valid_goids)
+                goids = filter(lambda x: re.search(patt, self.graph.name(x)), goids)
             except re.error:
                 msg = f"Invalid pattern: {pattern}"
-                self.errors.append(msg)
+                if errors is not None:
+                    errors.append(msg)
 
         # Apply mincount filter.
-        self.valid_goids = set(filter(lambda x: len(self.go2inp[x]) >= mincount, self.valid_goids))
+        goids = set(filter(lambda x: len(self.go2inp[x]) >= mincount, goids))
+
+        return goids
+
+    def estimate(self, root=utils.NS_ALL, pattern='', coverage=1, max_nodes=0, max_edges=0):
+        """
+        The default coverage is the number of unique coverages - 1.
+
+        With a node or edge budget the coverage is the smallest one whose tree fits.
+        """
+        goids = self.select(root=root, mincount=coverage, pattern=pattern)
+        if not goids:
+            return 1
+        if max_nodes or max_edges:
+            return self.fit(goids, max_nodes=max_nodes, max_edges=max_edges)
+        uniq = len(set(len(self.go2inp[x]) for x in goids))
+        return max([1, uniq - 1])
+
+    def sizes(self, goids):
+        """
+        Returns the number of nodes and edges of the tree for each coverage cutoff.
+
+        A node is in the tree of a cutoff when it or one of its descendants
+        passes the cutoff. The trees are counted without building them.
+        """
+        graph = self.graph
+
+        # The highest coverage at or below each node.
+        best = dict.fromkeys(self.topo, 0)
+        for goid in goids:
+            best[graph.index(goid)] = len(self.go2inp[goid])
+
+        # Push the coverages upwards, children before parents.
+        for idx in reversed(self.topo):
+            value = best[idx]
+            if value:
+                for parent in graph.parents(idx):
+                    if best[parent] < value:
+                        best[parent] = value
+
+        # Each node brings the edges to its parents, the parents are in the tree as well.
+        nodes, edges = Counter(), Counter()
+        for idx, value in best.items():
+            if value:
+                nodes[value] += 1
+                edges[value] += len(graph.parents(idx))
+
+        # Accumulate from the highest cutoff downwards.
+        result = {}
+        total_nodes = total_edges = 0
+        for value in sorted(nodes, reverse=True):
+            total_nodes += nodes[value]
+            total_edges += edges[value]
+            result[value] = (total_nodes, total_edges)
+
+        return result
+
+    def fit(self, goids, max_nodes=0, max_edges=0):
+        """
+        Returns the smallest coverage whose tree fits the budget, the largest coverage if none fits.
+        """
+        sizes = self.sizes(goids)
+        cutoffs = sorted(sizes)
+        for cutoff in cutoffs:
+            nodes, edges = sizes[cutoff]
+            if (not max_nodes or nodes <= max_nodes) and (not max_edges or edges <= max_edges):
+                return cutoff
+        return cutoffs[-1]
+
+    def run(self, root=utils.NS_ALL, mincount=1, pattern='', progress=None):
+        """
+        Returns the run for the filters. Repeated filters return the same run.
+        """
+        key = (root, mincount, pattern)
+        run = self.runs.get(key)
+        if run is None:
+            run = Run(self.idg, root=root, mincount=mincount, pattern=pattern, progress=progress, session=self)
+            self.runs.put(key, run)
+        return run
+
+
+class Run:
+
+    def __init__(self, idg, targets=[], root=utils.NS_ALL, mincount=1, pattern='', progress=None, session=None):
+
+        # The mapping of the targets is shared by the runs of a session.
+        if session is None:
+            session = Session(idg, targets=targets, progress=progress)
+
+        self.session = session
+
+        # Collects errors
+        self.errors = list(session.errors)
+
+        # The index object
+        self.idg = idg
+        self.idx = idg.idx
+
+        self.graph = idg.graph
+
+        # The mappings of the input targets.
+        self.targets = session.targets
+        self.missing_targets = session.missing_targets
+        self.valid_targets = session.valid_targets
+        self.go2inp = session.go2inp
+        self.goids = session.goids
+        self.missing_goids = session.missing_goids
+
+        # Nodes to build the subgraph from.
+        self.valid_goids = session.select(root=root, mincount=mincount, pattern=pattern, errors=self.errors)
 
         # Check for input.
         if not self.valid_goids:
@@ -104,69 +300,80 @@ class Run:
             self.errors.append(msg1)
             self.errors.append(msg2)
 
-        # Find the ancestors for each node.
-        anc = set()
-        for node in self.valid_goids:
-            anc = anc.union(nx.ancestors(self.graph, node))
-
-        # Add the original nodes basck well.
-        anc = anc.union(self.valid_goids)
+        report(progress, STAGE_ANCESTORS)
 
-        # Subset the graph to the ancestors only.
-        tree = self.graph.subgraph(anc)
-
-        # Initialize the subtree
-        for node_id in tree.nodes():
-            node = tree.nodes[node_id]
-            sources = self.go2inp.get(node_id, [])
-            attr = NodeAttr()
-            attr.is_input = node_id in self.valid_goids
-            attr.sources = list(sources)
-            node[ATTR_KEY] = attr
+        # The integer positions of the valid nodes.
+        valid_idx = list(map(self.graph.index, self.valid_goids))
 
-        # Travers and update the cumulative totals
-        def traverse(tree, node_id, store):
+        # The union of the precomputed ancestors for each node.
+        anc = self.graph.ancestor_union(valid_idx)
 
-            store[node_id] = [node_id]
+        # Add the original nodes back as well.
+        anc.update(valid_idx)
 
-            for child_id in tree.successors(node_id):
-                if child_id not in store:
-                    traverse(tree, child_id, store)
-                    store[node_id].extend(store[child_id])
+        # Subset the graph to the ancestors only, the session keeps the nodes sorted.
+        tree = SubGraph(self.graph, anc, order=[idx for idx in session.order if idx in anc])
 
-            # Add up the totals from the subtree.
-            totals = []
-            for parent_id in store[node_id]:
-                totals += tree.nodes[parent_id][ATTR_KEY].sources
+        report(progress, STAGE_PROPAGATION)
 
-            # Shortcut to the node
-            node = tree.nodes[node_id]
+        # Positions of the nodes in the sorted tree.
+        tree_pos = {idx: pos for pos, idx in enumerate(tree.order)}
 
-            # Store the descendants from the subtree only.
-            node[ATTR_KEY].descendants = set(store[node_id])
+        # Parallel arrays over the tree nodes.
+        size = len(tree.order)
+        self.is_input = bytearray(size)
+        self.src_bits = [0] * size
+        self.all_bits = [0] * size
+        self.desc_bits = [0] * size
 
-            # Add the cumulative totals
-            node[ATTR_KEY].sources_all = list(set(totals))
-
-        roots = filter(lambda x: tree.in_degree(x) == 0, tree.nodes())
-        for root in roots:
-            store = dict()
-            traverse(tree, root, store=store)
-
-        # Need a sorted tree for stability.
-        self.tree = nx.DiGraph()
-        self.tree.add_nodes_from(sorted(tree.nodes(data=True)))
-        self.tree.add_edges_from(tree.edges(data=True))
+        # Initialize the subtree
+        valid_idx = set(valid_idx)
+        for pos, idx in enumerate(tree.order):
+            self.is_input[pos] = idx in valid_idx
+            self.src_bits[pos] = session.src.get(idx, 0)
+
+        # Propagate the sources and descendants upwards, children before parents.
+        for idx in reversed([idx for idx in session.topo if idx in anc]):
+            pos = tree_pos[idx]
+            all_bits = self.src_bits[pos]
+            desc_bits = 1 << pos
+            for child in tree.children(idx):
+                child_pos = tree_pos[child]
+                all_bits |= self.all_bits[child_pos]
+                desc_bits |= self.desc_bits[child_pos]
+            self.all_bits[pos] = all_bits
+            self.desc_bits[pos] = desc_bits
+
+        # The additional attributes of the nodes in the tree.
+        self.attrs = dict((self.graph.ids[idx], NodeAttr(self, pos)) for pos, idx in enumerate(tree.order))
+
+        self.tree = tree
+
+    def decode_targets(self, bits):
+        """
+        Returns the input targets in a bitset.
+        """
+        return [self.valid_targets[x] for x in utils.bit_positions(bits)]
+
+    def as_networkx(self):
+        """
+        Returns the tree as a networkx DiGraph, the node attributes are stored under ATTR_KEY.
+        """
+        graph = self.tree.to_networkx()
+        for node_id, attr in self.attrs.items():
+            graph.nodes[node_id][ATTR_KEY] = attr
+        return graph
 
     def as_pydot(self):
+        import pydot
 
         # Create the pydot graph.
         pg = pydot.Dot("genescape", graph_type="digraph")
 
         # Create a custom node for each node in the tree.
-        for goid in self.tree.nodes():
-            node = self.tree.nodes[goid]
-            attr = node[ATTR_KEY]
+        for goid in self.tree:
+            node = self.graph.node(goid)
+            attr = self.attrs[goid]
 
             name = node["name"]
 
@@ -207,17 +414,20 @@ class Run:
 
         return pg
 
-    def as_df(self):
+    def table(self):
+        """
+        Returns the rows of the annotation table, unsorted.
+        """
 
         # Find the input nodes
-        nodes = filter(lambda x: self.tree.nodes[x][ATTR_KEY].is_input, self.tree.nodes())
+        nodes = filter(lambda x: self.attrs[x].is_input, self.tree)
 
         inp_size = len(self.valid_targets)
 
         rows = []
         for node_id in nodes:
-            node = self.tree.nodes[node_id]
-            attr = node[ATTR_KEY]
+            node = self.graph.node(node_id)
+            attr = self.attrs[node_id]
             func_name = node["name"]
             source = "|".join(sorted(attr.sources))
             count = attr.src_len
@@ -233,14 +443,41 @@ class Run:
             }
             rows.append(data)
 
-        df = pd.DataFrame(rows)
+        return rows
+
+    def as_rows(self):
+        """
+        Returns the rows of the annotation table in the order of the dataframe, without pandas.
+        """
+        return sort_rows(self.table())
+
+    def as_csv(self):
+        """
+        Returns the annotation table as the CSV text of the dataframe.
+        """
+        rows = self.as_rows()
+        if not rows:
+            return "\n"
+        stream = io.StringIO()
+        writer = csv.DictWriter(stream, fieldnames=list(rows[0]), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+        return stream.getvalue()
+
+    def as_df(self):
+        import pandas as pd
 
         # Sort the results.
-        if not df.empty:
-            df = df.sort_values(by='Coverage', ascending=False)
+        df = pd.DataFrame(sort_rows(self.table()))
 
         return df
 
+def sort_rows(rows):
+    """
+    Sorts the rows by decreasing coverage, the ties by GO term.
+    """
+    return sorted(rows, key=lambda row: (-row['Coverage'], row['GO']))
+
 WIDTH = 35.0
 HEIGHT = 12.0
 
@@ -281,18 +518,11 @@ def human_readable(value, digits=0):
     newval = f"{newval:d}K" if newval > 1 else value
     return newval
 
-@utils.memoize
 def load_index_graph(fname):
     """
     Loads and index and initializes the graph.
     """
-    # Load the index.
-    idx = gs_index.load_index(fname)
-
-    # Produce the index graph
-    idx = gs_index.IndexGraph(idx)
-
-    return idx
+    return gs_index.load_index_graph(fname)
 
 
 # Returns N random symbols from the index
@@ -301,25 +531,42 @@ def random_symbols(idg, N=10):
     syms = random.sample(values, N)
     return list(sorted(syms))
 
-def subgraph(idg, targets, root=utils.NS_ALL, coverage=1, pattern=''):
+def subgraph(idg, targets, root=utils.NS_ALL, coverage=1, pattern='', progress=None, session=None):
     utils.info(str(idg.idx))
-    res = Run(idg=idg, targets=targets, root=root, mincount=coverage, pattern=pattern)
+    if session is not None:
+        return session.run(root=root, mincount=coverage, pattern=pattern, progress=progress)
+    res = Run(idg=idg, targets=targets, root=root, mincount=coverage, pattern=pattern, progress=progress)
     return res
 
-def estimate(idg, targets, root=utils.NS_ALL, coverage=1, pattern=''):
+def estimate(idg, targets, root=utils.NS_ALL, coverage=1, pattern='', progress=None, max_nodes=0, max_edges=0):
     """
     The default coverage is the number of unique coverages - 1.
+
+    With max_nodes or max_edges the coverage is the smallest one whose tree fits.
     """
-    res = Run(idg=idg, targets=targets, root=root, mincount=coverage, pattern=pattern)
-    df = res.as_df()
-    if df.empty:
-        return 1
-    else:
-        uniq = df['Coverage'].nunique()
-        cov = max( [1, uniq - 1] )
+    session = Session(idg, targets=targets, progress=progress)
+    cov = session.estimate(root=root, pattern=pattern, coverage=coverage, max_nodes=max_nodes, max_edges=max_edges)
     utils.info(f"coverage={cov}")
     return cov
 
+def annotate(idg, targets, root=utils.NS_ALL, coverage=0, pattern='', progress=None, session=None, max_nodes=0,
+             max_edges=0):
+    """
+    Estimates the coverage when not set and builds the tree from the same session.
+
+    Returns the run and the coverage.
+    """
+    utils.info(str(idg.idx))
+    if session is None:
+        session = Session(idg, targets=targets, progress=progress)
+    if coverage < 1:
+        coverage = session.estimate(root=root, pattern=pattern, max_nodes=max_nodes, max_edges=max_edges)
+        utils.info(f"coverage={coverage}")
+    run = session.run(root=root, mincount=coverage, pattern=pattern, progress=progress)
+    utils.check_budget(run.tree.number_of_nodes(), run.tree.number_of_edges(), max_nodes=max_nodes,
+                       max_edges=max_edges)
+    return run, coverage
+
 def demo():
     # Initialize the graph datastructure.
     from genescape import resources
@@ -1,11 +1,30 @@
 """
 Represents a GeneScape index.
 """
-import csv, gzip, json, os, random
+import csv, gzip, hashlib, json, os, random, shutil, sys, tempfile, threading, time
+from array import array
 from pathlib import Path
 from itertools import tee, takewhile, dropwhile, islice
-from genescape import utils
-import networkx as nx
+from genescape import utils, gs_binary, gs_cache, gs_ontology
+from genescape.gs_ontology import OntoGraph
+
+# The supported index file formats.
+FORMAT_JSON, FORMAT_BIN = "json", "bin"
+
+# The loaded indexes with their graphs.
+INDEXES = gs_cache.IndexCache()
+
+# The number of entries sampled to estimate the size of an index.
+SIZE_SAMPLE = 5000
+
+# The environment variable that sets the directory of the shared indexes.
+SHARED_ENV = "GENESCAPE_SHARED"
+
+# The directory where JSON indexes are published as binary indexes, off when empty.
+SHARED_DIR = os.environ.get(SHARED_ENV, "")
+
+# The seconds between the checks of the watched index files.
+WATCH_INTERVAL = 10
 
 class Index:
 
@@ -49,8 +68,11 @@ class Index:
         # Maps names to symbols (synonyms).
         self.name2sym = self.data.get(self.NAME2SYM)
 
+        # The binary storage when loaded from a binary index.
+        self.store = None
+
         # The graph representation of the ontology.
-        self.graph = nx.DiGraph()
+        self.graph = None
 
     def init_graph(self):
         self.graph = build_graph(self)
@@ -82,6 +104,9 @@ class IndexGraph:
         # Generate the graph.
         self.graph = build_graph(idx)
 
+        # The path, modification time and size of the file the index was loaded from.
+        self.identity = None
+
     def __str__(self):
         return f"# IndexGraph\n# {self.idx}\n# {self.graph}"
 
@@ -162,28 +187,123 @@ def parse_obo(obo_fname, idx):
         continue
 
     # Last term needs to be added
-    obo[term["id"]] = term
+    if term and not term.get("is_obsolete", False):
+        obo[term["id"]] = term
 
     return idx
 
-@utils.timer
-def parse_gaf(fname, idx):
+def open_gaf(fname, mode="rt"):
+    """
+    Opens a GAF file, gzipped or plain.
+    """
+    return utils.open_file(fname, mode=mode)
 
-    # Open the file
-    info = idx.info
 
-    stream = gzip.open(fname, mode="rt", encoding="UTF-8")
+def add_value(store, key, value):
+    """
+    Adds a value to the set stored under a key.
+    """
+    values = store.get(key)
+    if values is None:
+        values = store[key] = set()
+    values.add(value)
 
-    stream, header = tee(stream, 2)
 
-    # Parse the headers
+def parse_gaf_lines(lines):
+    """
+    Parses GAF body lines into partial maps of sets.
+
+    Returns the symbol to GO ids, the GO id to symbols, the names to
+    symbols and the number of rows parsed.
+    """
+    sym2go, go2sym, name2sym = {}, {}, {}
+
+    # Canonical strings, repeated values share one object and pickle once.
+    table = {}
+
+    rows = 0
+    for line in lines:
+        if line.startswith("!"):
+            continue
+        row = line.split("\t", 5)
+        if len(row) < 5:
+            continue
+        rows += 1
+
+        # Convert to uppercase.
+        name = table.setdefault(row[1].upper(), row[1].upper())
+        symb = table.setdefault(row[2].upper(), row[2].upper())
+        goid = table.setdefault(row[4].upper(), row[4].upper())
+
+        add_value(sym2go, symb, goid)
+        add_value(sym2go, name, goid)
+        add_value(go2sym, goid, symb)
+        name2sym[name] = symb
+
+    return sym2go, go2sym, name2sym, rows
+
+
+def parse_gaf_chunk(path, start, end):
+    """
+    Parses the byte range of an uncompressed GAF file.
+    """
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    # Split on newlines only, as the serial parse does.
+    lines = data.decode("utf-8").split("\n")
+    return parse_gaf_lines(lines)
+
+
+def gaf_chunks(path, start, count):
+    """
+    Splits a file into byte ranges that end on line boundaries.
+    """
+    size = os.path.getsize(path)
+    step = max(1, (size - start) // count)
+    bounds = [start]
+    with open(path, "rb") as fp:
+        while bounds[-1] < size:
+            fp.seek(min(bounds[-1] + step, size))
+            fp.readline()
+            bounds.append(min(fp.tell(), size))
+    return [(bounds[pos], bounds[pos + 1]) for pos in range(len(bounds) - 1)]
+
+
+def merge_gaf(parts, idx):
+    """
+    Merges the partial maps with set semantics. Later parts win for the names.
+    """
+    sym2go, go2sym, name2sym = {}, {}, {}
+    rows = 0
+    for part_sym2go, part_go2sym, part_name2sym, count in parts:
+        for store, part in ((sym2go, part_sym2go), (go2sym, part_go2sym)):
+            for key, values in part.items():
+                if key in store:
+                    store[key].update(values)
+                else:
+                    store[key] = values
+        name2sym.update(part_name2sym)
+        rows += count
+
+    # Update the index storage, the values are sorted so that the index does not depend on the chunks.
+    idx.sym2go.update((key, sorted(values)) for key, values in sym2go.items())
+    idx.go2sym.update((key, sorted(values)) for key, values in go2sym.items())
+    idx.name2sym.update(name2sym)
+
+    return rows
+
+
+def parse_gaf_header(header, info):
+    """
+    Fills the info object from the header lines of a GAF file.
+    """
     header = takewhile(lambda x: x.startswith("!"), header)
     header = map(lambda x: x.strip("!"), header)
     header = map(lambda x: x.strip(""), header)
     header = filter(None, header)
     header = csv.reader(header, delimiter=" ")
     header = filter(lambda x: len(x)>1, header)
-    info ['gaf_fname'] = Path(fname).name
     for row in header:
         key = row[0].strip(":")
         if key == "gaf-version" or key == "go-version":
@@ -191,37 +311,55 @@ def parse_gaf(fname, idx):
         elif key == "generated-by" or key == "date-generated":
             info.setdefault(key, []).append(row[1])
 
-    # Iterate over the body
-    stream = dropwhile(lambda x: x.startswith("!"), stream)
-    stream = map(lambda x: x.strip(), stream)
-    stream = csv.reader(stream, delimiter="\t")
-    #stream = islice(stream, 1000)
-    sym2go, go2sym, name2sym = {}, {}, {}
-    for row in stream:
-        name, symb, goid, synon = row[1], row[2], row[4], row[10]
 
-        # Convert to uppercase.
-        name = name.upper()
-        symb = symb.upper()
-        goid = goid.upper()
+@utils.timer
+def parse_gaf(fname, idx, jobs=1, tmpdir=None):
+    """
+    Parses a GAF file into the index.
 
-        sym2go.setdefault(symb, []).append(goid)
-        sym2go.setdefault(name, []).append(goid)
+    With more than one job the file is decompressed once into a temporary
+    file that is split into byte ranges parsed in a process pool.
+    """
+    start = time.time()
 
-        go2sym.setdefault(goid, []).append(symb)
-        name2sym[name] = symb
+    # Open the file
+    info = idx.info
 
-    # Remove duplicates in case these exists.
-    for key in sym2go:
-        sym2go[key] = list(set(sym2go[key]))
+    handle = open_gaf(fname)
 
-    for key in go2sym:
-        go2sym[key] = list(set(go2sym[key]))
+    stream, header = tee(handle, 2)
 
-    # Update the index storage.
-    idx.sym2go.update(sym2go)
-    idx.go2sym.update(go2sym)
-    idx.name2sym.update(name2sym)
+    # Parse the headers
+    parse_gaf_header(header, info)
+    info ['gaf_fname'] = Path(fname).name
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        handle.close()
+
+        # Decompress once into a file that the workers can seek in.
+        with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+            path = Path(tmp) / "body.gaf"
+            with open_gaf(fname, mode="rb") as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+            # Parse the chunks in parallel.
+            chunks = gaf_chunks(path, start=0, count=jobs * 4)
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(parse_gaf_chunk, path, beg, end) for beg, end in chunks]
+                parts = [future.result() for future in futures]
+    else:
+        # Iterate over the body
+        parts = [parse_gaf_lines(stream)]
+        handle.close()
+
+    rows = merge_gaf(parts, idx)
+
+    # Report the throughput.
+    elapsed = time.time() - start
+    rate = rows / elapsed if elapsed else 0
+    utils.info(f"gaf: {rows:,d} rows in {elapsed:.2f} seconds ({rate:,.0f} rows/s, jobs={jobs})")
 
     obo = idx.obo
     # Fill in annotation counts
@@ -232,8 +370,203 @@ def parse_gaf(fname, idx):
 
     return idx
 
-@utils.memoize
+def index_size(idx):
+    """
+    Estimates the memory held by an index in bytes.
+
+    Binary indices count their mapped file, the dictionaries of JSON
+    indices are summed up. The shared ontology graph is not counted.
+    """
+    if idx.store is not None:
+        return idx.store.path.stat().st_size
+
+    def item_size(item):
+        key, value = item
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(map(sys.getsizeof, value))
+        return size
+
+    # The entries are sampled evenly, the sizes are extrapolated.
+    size = 0
+    for data in (idx.sym2go, idx.go2sym, idx.name2sym):
+        step = max(1, len(data) // SIZE_SAMPLE)
+        sample = list(islice(data.items(), 0, None, step))
+        if sample:
+            size += sum(map(item_size, sample)) * len(data) // len(sample)
+        size += sys.getsizeof(data)
+    return int(size)
+
+
+def shared_path(path, shared_dir):
+    """
+    Returns the path of the published binary index of an index file.
+
+    The name changes with the path, modification time and size of the source.
+    """
+    path, mtime, size = gs_cache.index_identity(path)
+    digest = hashlib.sha1(f"{path}:{mtime}:{size}".encode(), usedforsecurity=False).hexdigest()[:16]
+    stem = Path(path).name.split(".")[0]
+    return Path(shared_dir) / f"{stem}-{digest}.index.bin"
+
+
+def publish(path, shared_dir):
+    """
+    Publishes an index file as a binary index in the shared directory. Returns the path to load.
+
+    Binary indexes are returned as they are. The conversion runs once, the
+    processes that publish the same index at the same time wait for it.
+    """
+    path = Path(path)
+    if not path.exists():
+        utils.stop(f"file not found: {path}")
+
+    if gs_binary.is_binary(path):
+        return path
+
+    target = shared_path(path, shared_dir)
+    if target.exists():
+        return target
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    # Only one process converts, the others wait on the lock.
+    with open(target.with_suffix(".lock"), "w") as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+
+        if not target.exists():
+            start = time.time()
+            tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+            try:
+                save_index(read_index(path), tmp, fmt=FORMAT_BIN)
+                os.replace(tmp, target)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+            utils.info(f"published: {target} in {time.time() - start:.2f} seconds")
+
+    return target
+
+
+def read_index_graph(path):
+    """
+    Reads an index file with its graph.
+
+    With a shared directory the index is loaded from its published binary
+    index, the processes that load it share the mapped pages.
+    """
+    path = Path(path)
+
+    # The identity is taken first, a file that changes during the load is loaded again.
+    identity = gs_cache.index_identity(path) if path.exists() else None
+
+    fname = publish(path, SHARED_DIR) if SHARED_DIR else path
+    idg = IndexGraph(read_index(fname))
+    idg.identity = identity
+
+    return idg
+
+
+def load_index_graph(path):
+    """
+    Returns the index with its graph, loaded once into the index cache.
+    """
+    path = Path(path)
+    return INDEXES.get(str(path.resolve()), lambda: read_index_graph(path), sizeof=lambda x: index_size(x.idx))
+
+
+def reload_index_graph(path):
+    """
+    Reads an index file again and swaps it into the index cache.
+
+    The queries that hold the previous index finish with it.
+    """
+    start = time.time()
+    path = Path(path)
+    idg = read_index_graph(path)
+    INDEXES.swap(str(path.resolve()), idg, nbytes=index_size(idg.idx), seconds=time.time() - start)
+    utils.info(f"reloaded: {path} in {time.time() - start:.2f} seconds")
+    return idg
+
+
+class Watcher:
+    """
+    Reloads the loaded indexes whose files change, checking in a background thread.
+
+    A file is reloaded once its size and modification time stay the same
+    between two checks, so that files being written are not read.
+    """
+
+    def __init__(self, paths, interval=WATCH_INTERVAL):
+        self.paths = list(map(Path, paths))
+        self.interval = interval
+        self.pending = dict()
+        self.failed = dict()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def check(self):
+        """
+        Checks the files once. Returns the paths that were reloaded.
+        """
+        reloaded = []
+        for path in self.paths:
+            key = str(path.resolve())
+            idg = INDEXES.peek(key)
+
+            # Indexes that are not loaded are read fresh on first use.
+            if idg is None or not path.exists():
+                continue
+
+            identity = gs_cache.index_identity(path)
+            if identity == idg.identity or identity == self.failed.get(key):
+                self.pending.pop(key, None)
+                continue
+
+            # Wait for the file to settle.
+            if self.pending.get(key) != identity:
+                self.pending[key] = identity
+                continue
+
+            try:
+                reload_index_graph(path)
+                reloaded.append(path)
+            except (Exception, SystemExit) as exc:
+                self.failed[key] = identity
+                utils.error(f"reload failed: {path}: {exc}")
+            self.pending.pop(key, None)
+
+        return reloaded
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="index-watcher", daemon=True)
+        self.thread.start()
+        utils.info(f"watching {len(self.paths)} index files every {self.interval} seconds")
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+
 def load_index(path):
+    """
+    Returns the index, loaded once into the index cache.
+    """
+    return load_index_graph(path).idx
+
+
+def read_index(path):
+    """
+    Reads an index file.
+    """
     if not isinstance(path, Path):
         path = Path(path)
 
@@ -241,18 +574,64 @@ def load_index(path):
     if not path.exists():
         utils.stop(f"file not found: {path}")
 
-    stream = gzip.open(path, "rb") if path.name.endswith(".gz") else open(path, "rt")
-    with stream as fp:
-        text = fp.read().decode('utf-8')
-        data = json.loads(text)
+    # Binary indices are memory mapped.
+    if gs_binary.is_binary(path):
+        idx = gs_binary.load_index(path)
+    else:
+        stream = gzip.open(path, "rb") if path.name.endswith(".gz") else open(path, "rt")
+        with stream as fp:
+            text = fp.read().decode('utf-8')
+            data = json.loads(text)
+        idx = Index(data=data)
+
+    # Indices of the same ontology share the graph.
+    idx = share_graph(idx)
+
+    return idx
+
+
+def share_graph(idx):
+    """
+    Sets the graph of a loaded index to the shared ontology graph, with the counts of the index as an overlay.
+
+    The term dictionaries of JSON indices are replaced by a view over the graph.
+    """
+    version = idx.info.get("data-version", "")
+
+    # Binary indices carry the graph arrays and the counts.
+    store = idx.store
+    if store is not None:
+        ids = (store.terms[pos] for pos in range(store.header["obo_count"]))
+        key = (version, gs_ontology.fingerprint(ids))
+        idx.graph = gs_ontology.shared(key, build=lambda: OntoGraph.from_store(store), counts=store.counts)
+        return idx
+
+    obo = idx.obo
+    ids = [goid for goid, row in obo.items() if not row.get("is_obsolete")]
+    key = (version, gs_ontology.fingerprint(ids))
+
+    # The per node counts.
+    counts = dict()
+    for name in (idx.ANNO_COUNT, idx.ANNO_TOTAL, idx.DESC_COUNT):
+        counts[name] = array("i", [obo[goid].get(name, -1) for goid in ids])
+
+    idx.graph = gs_ontology.shared(key, build=lambda: OntoGraph.from_obo(obo), counts=counts)
+
+    # The term dictionaries are generated from the shared graph.
+    idx.obo = idx.data[idx.OBO_KEY] = gs_ontology.TermMap(idx.graph)
 
-    idx = Index(data=data)
     return idx
 
-def save_index(idx, path):
+def save_index(idx, path, fmt=FORMAT_JSON):
 
     if not isinstance(path, Path):
         path = Path(path)
+
+    # Binary indices are written uncompressed so that they can be memory mapped.
+    if fmt == FORMAT_BIN:
+        gs_binary.save_index(idx, path)
+        return
+
     stream = gzip.open(path, "wb") if path.name.endswith(".gz") else open(path, "wb")
     with stream as fp:
         text = json.dumps(idx.data, indent=4)
@@ -261,36 +640,20 @@ def save_index(idx, path):
 
 def build_graph(idx):
     """
-    Build an ontology graph from a JSON data structure.
+    Build an ontology graph from the index.
     """
-    # The complete ontology graph
-    graph = nx.DiGraph()
+    # The graph may already be set, for example from a compiled ontology.
+    if idx.graph is not None:
+        return idx.graph
 
-    # Remove obsolete terms.
-    nodes = filter(lambda x: not x.get("is_obsolete"), idx.obo.values())
+    # Binary indices carry the graph arrays.
+    if idx.store is not None:
+        return OntoGraph.from_store(idx.store)
 
-    # nodes = islice(nodes, 100)
-    nodes = list(nodes)
+    # The per node counts.
+    keys = [idx.DESC_COUNT, idx.ANNO_COUNT, idx.ANNO_TOTAL]
 
-    # Add individual nodes to the
-    for row in nodes:
-        oid = row["id"]
-        name = row["name"]
-        namespace = utils.NAMESPACE_MAP.get(row[idx.NAMESPACE], "?")
-        anno_count = row.get(idx.ANNO_COUNT, -1)
-        anno_total = row.get(idx.ANNO_TOTAL, -1)
-        desc_count = row.get(idx.DESC_COUNT, -1)
-        kwargs = {idx.DESC_COUNT: desc_count, idx.ANNO_COUNT: anno_count, idx.ANNO_TOTAL: anno_total}
-
-        graph.add_node(oid, id=oid, name=name, namespace=namespace, **kwargs)
-
-    for row in nodes:
-        child = row["id"]
-        for parent in row.get("is_a", []):
-            if graph.has_node(parent):
-                graph.add_edge(parent, child)
-            else:
-                utils.warn(f"# Missing parent: {parent} for {row}")
+    graph = OntoGraph.from_obo(idx.obo, count_keys=keys)
 
     return graph
 
@@ -304,15 +667,31 @@ def finalize_index(idx):
     # Build the initial graph
     graph = gs.graph
 
+    # Fill in the cumulative counts.
+    update_counts(idx, graph)
+
+    # Precompute the ancestors of each term, the binary format stores them.
+    graph.init_closure()
+
+    # Keep the graph with the index.
+    idx.graph = graph
+
+    return idx
+
+
+def update_counts(idx, graph):
+    """
+    Fills in the descendant counts and the cumulative annotation totals.
+    """
     # Shortcut to the OBO object.
     obo = idx.obo
 
     # Add the degree to the nodes
-    for node_id in graph.nodes():
+    for node_id in graph:
         obo[node_id][idx.DESC_COUNT] = graph.out_degree(node_id)
 
     # Update annotations for each node
-    topo_nodes = list(nx.topological_sort(graph))
+    topo_nodes = graph.topological_sort()
 
     for node_id in reversed(topo_nodes):
         total = obo[node_id][idx.ANNO_TOTAL]
@@ -321,16 +700,16 @@ def finalize_index(idx):
             obo[pre][idx.ANNO_TOTAL] += total
             obo[pre][idx.DESC_COUNT] += desc_count
 
-    return idx
-
 
-def build_index(obo_fname, gaf_fname, fname):
+def build_index(obo_fname, gaf_fname, fname, jobs=1, tmpdir=None, cache_dir=None):
     """
     Build an index from an OBO and GAF file.
     """
+    from genescape import gs_obo
+
     idx = Index()
-    idx = parse_obo(obo_fname, idx=idx)
-    idx = parse_gaf(gaf_fname, idx=idx)
+    idx = gs_obo.read_obo(obo_fname, idx=idx, cache_dir=cache_dir)
+    idx = parse_gaf(gaf_fname, idx=idx, jobs=jobs, tmpdir=tmpdir)
     idx = finalize_index(idx)
     return idx
 
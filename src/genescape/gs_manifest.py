@@ -0,0 +1,113 @@
+"""
+Builds the indexes of several organisms in parallel.
+
+The organisms are listed in a TOML manifest:
+
+    obo = "obo/go-basic.obo.gz"
+
+    [[genomes]]
+    name = "human"
+    gaf = "obo/goa_human.gaf.gz"
+    index = "obo/human.index.gz"
+
+An entry may set the format of its index, "json" or "bin".
+
+The ontology is compiled once, before the builds start. Each worker
+loads the compiled ontology and builds one organism at a time.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import toml
+
+from genescape import gs_index, gs_obo, utils
+
+
+def read_manifest(fname):
+    """
+    Reads a manifest file. Returns the OBO file and the list of genomes.
+    """
+    config = toml.load(fname)
+    genomes = config.get("genomes", [])
+    for entry in genomes:
+        if "name" not in entry or "gaf" not in entry:
+            utils.stop(f"genome entries need a name and a gaf: {entry}")
+        entry.setdefault("index", f"{entry['name']}.index.gz")
+        if entry.get("format", gs_index.FORMAT_JSON) not in (gs_index.FORMAT_JSON, gs_index.FORMAT_BIN):
+            utils.stop(f"invalid format for {entry['name']}: {entry['format']}")
+    return config.get("obo"), genomes
+
+
+def build_genome(entry, obo_fname, fmt, cache_dir, mem=None, tmpdir=None):
+    """
+    Builds the index of one genome. Returns the name, the elapsed time and the file size.
+    """
+    start = time.time()
+
+    name, gaf_fname, idx_fname = entry["name"], entry["gaf"], entry["index"]
+
+    # The entries may override the index format.
+    fmt = entry.get("format", fmt)
+
+    # Only binary indexes are built out of core.
+    if mem and fmt == gs_index.FORMAT_BIN:
+        from genescape import gs_build
+        gs_build.build_index(obo_fname=obo_fname, gaf_fname=gaf_fname, fname=idx_fname, mem=mem, tmpdir=tmpdir,
+                             cache_dir=cache_dir)
+    else:
+        idx = gs_index.build_index(obo_fname=obo_fname, gaf_fname=gaf_fname, fname=idx_fname, tmpdir=tmpdir,
+                                   cache_dir=cache_dir)
+        gs_index.save_index(idx, idx_fname, fmt=fmt)
+
+    elapsed = time.time() - start
+    size = Path(idx_fname).stat().st_size / 1024 / 1024
+
+    return name, elapsed, size
+
+
+def build_all(genomes, obo_fname, cache_dir, jobs=1, fmt=gs_index.FORMAT_JSON, mem=None, tmpdir=None):
+    """
+    Builds the indexes of all genomes in a process pool.
+    """
+    start = time.time()
+
+    # Compile the ontology once, the workers load the compiled file.
+    path = gs_obo.cache_path(obo_fname, cache_dir)
+    if not path.exists():
+        gs_obo.compile_obo(obo_fname, path)
+
+    utils.info(f"building {len(genomes)} indexes (jobs={jobs})")
+
+    timings, failed = {}, []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(build_genome, entry, obo_fname=obo_fname, fmt=fmt, cache_dir=cache_dir, mem=mem,
+                               tmpdir=tmpdir): entry for entry in genomes}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                name, elapsed, size = future.result()
+            except SystemExit:
+                # The worker reported the error with utils.stop.
+                utils.error(f"{entry['name']}: build stopped")
+                failed.append(entry["name"])
+                continue
+            except Exception as exc:
+                utils.error(f"{entry['name']}: {exc}")
+                failed.append(entry["name"])
+                continue
+            timings[name] = elapsed
+            utils.info(f"{name}: {entry['index']} in {elapsed:.2f} seconds ({size:.2f} MB)")
+
+    # Report the timings in manifest order.
+    elapsed = time.time() - start
+    total = sum(timings.values())
+    utils.info(f"built {len(timings)} indexes in {elapsed:.2f} seconds (serial time {total:.2f} seconds)")
+    for entry in genomes:
+        if entry["name"] in timings:
+            utils.info(f"{entry['name']:>15s}: {timings[entry['name']]:.2f} seconds")
+
+    if failed:
+        utils.stop(f"failed builds: {', '.join(failed)}")
+
+    return timings
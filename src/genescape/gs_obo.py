@@ -0,0 +1,140 @@
+"""
+A compiled cache of the parsed ontology.
+
+Parsing the OBO file is the slowest step of building an index. The parsed
+terms and the derived graph arrays (parents, children, ancestors, the
+topological order and the depth of each term) are compiled into a binary
+file that is memory mapped by later builds.
+
+The compiled files are keyed by the data-version of the OBO file and the
+hash of its content.
+"""
+import hashlib
+import os
+import re
+import time
+from pathlib import Path
+
+from genescape import gs_binary, utils
+from genescape.gs_index import Index, parse_obo
+from genescape.gs_ontology import OntoGraph
+
+# The subdirectory of the storage directory that holds the compiled files.
+CACHE_DIR = "obo"
+
+
+def file_hash(fname):
+    """
+    Returns the SHA1 hash of the content of a file.
+    """
+    digest = hashlib.sha1(usedforsecurity=False)
+    with open(fname, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def data_version(obo_fname):
+    """
+    Returns the data-version in the header of an OBO file.
+    """
+    with utils.open_file(obo_fname) as stream:
+        for line in stream:
+            if line.startswith("[Term]"):
+                break
+            if line.startswith("data-version:"):
+                return line.split(":", 1)[1].strip()
+    return "unknown"
+
+
+def strings(table):
+    """
+    Returns the strings of a string table as a list.
+    """
+    blob, offs = bytes(table.blob), table.offs.tolist()
+    return [blob[offs[pos]:offs[pos + 1]].decode("utf-8") for pos in range(len(offs) - 1)]
+
+
+def cache_path(obo_fname, cache_dir):
+    """
+    Returns the path of the compiled file for an OBO file.
+    """
+    version = re.sub(r"[^\w.-]+", "_", data_version(obo_fname))
+    digest = file_hash(obo_fname)[:16]
+    return Path(cache_dir) / f"{version}-{digest}.obo.bin"
+
+
+def compile_obo(obo_fname, path):
+    """
+    Parses an OBO file and writes the compiled file.
+    """
+    idx = parse_obo(obo_fname, idx=Index())
+
+    graph = OntoGraph.from_obo(idx.obo)
+    graph.init_closure()
+    graph.init_order()
+
+    # Write into a temporary file, then move it into place.
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    writer = gs_binary.Writer(tmp)
+    header = gs_binary.write_terms(writer, obo=idx.obo, graph=graph, extra=[], counts=[])
+    writer.close(info=dict(idx.info), sha1=file_hash(obo_fname), **header)
+    os.replace(tmp, path)
+
+    utils.info(f"compiled: {path}")
+
+    return path
+
+
+def load_obo(obo_fname, idx, cache_dir):
+    """
+    Fills the index with the ontology, compiles the OBO file when it is not yet cached.
+
+    The graph of the index is set from the arrays of the compiled file.
+    """
+    start = time.time()
+
+    path = cache_path(obo_fname, cache_dir)
+    if not path.exists():
+        compile_obo(obo_fname, path)
+
+    store = gs_binary.Store(path)
+
+    # Rebuild the term dictionaries, the strings are decoded in bulk.
+    ids = strings(store.terms)
+    names = strings(store.names)
+    namespaces = [store.ns_names[code] for code in store.ns_codes.tolist()]
+    isa_ptr, isa_idx = store.isa_ptr.tolist(), store.isa_idx.tolist()
+    obo = idx.obo
+    for pos, key in enumerate(ids):
+        term = dict(id=key, name=names[pos], namespace=namespaces[pos])
+        beg, end = isa_ptr[pos], isa_ptr[pos + 1]
+        if beg != end:
+            term["is_a"] = [ids[x] for x in isa_idx[beg:end]]
+        obo[key] = term
+
+    idx.info.update(store.header["info"])
+    idx.info['obo_fname'] = Path(obo_fname).name
+
+    # The graph arrays are used as stored, the lookups by GO id are kept in Python.
+    graph = OntoGraph.from_store(store)
+    graph.ids = ids
+    graph.pos = {key: pos for pos, key in enumerate(graph.ids)}
+    idx.graph = graph
+
+    elapsed = time.time() - start
+    utils.info(f"obo: {path.name} in {elapsed:.2f} seconds")
+
+    return idx
+
+
+def read_obo(obo_fname, idx, cache_dir=None):
+    """
+    Fills the index with the ontology, via the compiled cache when a cache directory is given.
+    """
+    if cache_dir:
+        return load_obo(obo_fname, idx=idx, cache_dir=cache_dir)
+    return parse_obo(obo_fname, idx=idx)
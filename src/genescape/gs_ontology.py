@@ -0,0 +1,495 @@
+"""
+A compact, array backed representation of the ontology graph.
+
+Nodes are integer coded in ontology order. The parent and child adjacency
+are stored as offset/value arrays, the node attributes as parallel arrays.
+A networkx graph is only built when a caller asks for it.
+
+The ancestors of every node (the transitive closure) are precomputed into
+sorted offset/value arrays, so that ancestor unions and is-ancestor queries
+do not need to walk the graph. The topological order and the depth of each
+node may be precomputed as well.
+
+Indexes built from the same ontology share a single graph. The registry
+holds one graph per ontology, each index gets a shallow copy that only
+carries its own per node counts. A graph leaves the registry once the
+last index that uses it is gone.
+"""
+import copy
+import hashlib
+import threading
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import deque
+from collections.abc import Mapping
+
+from genescape import utils
+
+# The shared graphs keyed by the ontology version and the fingerprint of the term ids.
+# The overlays keep their graph alive, the registry only refers to it.
+REGISTRY = weakref.WeakValueDictionary()
+
+# Guards the registry.
+LOCK = threading.Lock()
+
+
+def uint_array(values=()):
+    return array("I", values)
+
+
+def invert(size, ptr, idx):
+    """
+    Inverts CSR adjacency arrays. Rows of the result are in increasing order.
+    """
+    counts = [0] * (size + 1)
+    for value in idx:
+        counts[value + 1] += 1
+    for pos in range(size):
+        counts[pos + 1] += counts[pos]
+    fill = counts[:-1]
+    out = uint_array([0]) * len(idx)
+    for row in range(size):
+        for value in idx[ptr[row]:ptr[row + 1]]:
+            out[fill[value]] = row
+            fill[value] += 1
+    return uint_array(counts), out
+
+
+class OntoGraph:
+    """
+    The ontology as a directed graph, edges point from parents to children.
+    """
+    __slots__ = ("ids", "pos", "size", "names", "ns_codes", "ns_names", "parent_ptr", "parent_idx",
+                 "child_ptr", "child_idx", "anc_ptr", "anc_idx", "topo", "depths", "counts", "base", "__weakref__")
+
+    def __init__(self, ids, pos, names, ns_codes, ns_names, parent_ptr, parent_idx, child_ptr=None, child_idx=None,
+                 anc_ptr=None, anc_idx=None, topo=None, depths=None, counts=None):
+
+        # The GO ids and the lookup of the node position by GO id.
+        self.ids = ids
+        self.pos = pos
+
+        # The number of nodes.
+        self.size = len(parent_ptr) - 1
+
+        # The node names.
+        self.names = names
+
+        # The namespace of each node as a code into the namespace names.
+        self.ns_codes = ns_codes
+        self.ns_names = ns_names
+
+        # The parents of each node.
+        self.parent_ptr = parent_ptr
+        self.parent_idx = parent_idx
+
+        # The children of each node.
+        if child_ptr is None:
+            child_ptr, child_idx = invert(self.size, parent_ptr, parent_idx)
+        self.child_ptr = child_ptr
+        self.child_idx = child_idx
+
+        # The sorted ancestors of each node, computed on first use when not given.
+        self.anc_ptr = anc_ptr
+        self.anc_idx = anc_idx
+
+        # The topological order and the depth of each node, computed on first use when not given.
+        self.topo = topo
+        self.depths = depths
+
+        # Precalculated per node counts.
+        self.counts = counts or {}
+
+        # The shared graph of an overlay.
+        self.base = None
+
+    @classmethod
+    def from_obo(cls, obo, count_keys=()):
+        """
+        Builds the graph from the OBO dictionary of an index.
+        """
+
+        # Remove obsolete terms.
+        nodes = [row for row in obo.values() if not row.get("is_obsolete")]
+
+        ids = [row["id"] for row in nodes]
+        pos = {oid: idx for idx, oid in enumerate(ids)}
+        names = [row["name"] for row in nodes]
+
+        # Map the namespaces to the short codes.
+        ns_names = []
+        ns_lookup = {}
+        ns_codes = array("B")
+        for row in nodes:
+            code = utils.NAMESPACE_MAP.get(row[utils.NAMESPACE], "?")
+            if code not in ns_lookup:
+                ns_lookup[code] = len(ns_names)
+                ns_names.append(code)
+            ns_codes.append(ns_lookup[code])
+
+        parent_ptr, parent_idx = uint_array([0]), uint_array()
+        for row in nodes:
+            for parent in row.get("is_a", []):
+                if parent in pos:
+                    parent_idx.append(pos[parent])
+                else:
+                    utils.warn(f"# Missing parent: {parent} for {row}")
+            parent_ptr.append(len(parent_idx))
+
+        counts = {key: array("i", [row.get(key, -1) for row in nodes]) for key in count_keys}
+
+        return cls(ids=ids, pos=pos, names=names, ns_codes=ns_codes, ns_names=ns_names,
+                   parent_ptr=parent_ptr, parent_idx=parent_idx, counts=counts)
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Builds the graph over the arrays of a binary index without copying them.
+        """
+        size = store.header["obo_count"]
+        ns_names = [utils.NAMESPACE_MAP.get(name, "?") for name in store.ns_names]
+        arrays = dict()
+        for name, key in [("sub_ptr", "child_ptr"), ("sub_idx", "child_idx"), ("anc_ptr", "anc_ptr"),
+                          ("anc_idx", "anc_idx"), ("topo", "topo"), ("depth", "depths")]:
+            if store.has(name):
+                arrays[key] = store.section(name)
+        return cls(ids=store.terms, pos=store.terms, names=store.names, ns_codes=store.ns_codes, ns_names=ns_names,
+                   parent_ptr=store.isa_ptr[:size + 1], parent_idx=store.isa_idx, counts=store.counts, **arrays)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, goid):
+        return self.index(goid) is not None
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield self.ids[idx]
+
+    def __str__(self):
+        return f"OntoGraph with {self.number_of_nodes():,d} nodes and {self.number_of_edges():,d} edges"
+
+    def index(self, goid):
+        """
+        Returns the integer position of a GO id or None.
+        """
+        idx = self.pos.get(goid)
+        return idx if idx is not None and idx < self.size else None
+
+    def nodes(self):
+        return list(self)
+
+    def number_of_nodes(self):
+        return self.size
+
+    def number_of_edges(self):
+        return self.parent_ptr[self.size]
+
+    def parents(self, idx):
+        return self.parent_idx[self.parent_ptr[idx]:self.parent_ptr[idx + 1]]
+
+    def children(self, idx):
+        return self.child_idx[self.child_ptr[idx]:self.child_ptr[idx + 1]]
+
+    def predecessors(self, goid):
+        return [self.ids[x] for x in self.parents(self.index(goid))]
+
+    def successors(self, goid):
+        return [self.ids[x] for x in self.children(self.index(goid))]
+
+    def in_degree(self, goid):
+        idx = self.index(goid)
+        return self.parent_ptr[idx + 1] - self.parent_ptr[idx]
+
+    def out_degree(self, goid):
+        idx = self.index(goid)
+        return self.child_ptr[idx + 1] - self.child_ptr[idx]
+
+    def name(self, goid):
+        return self.names[self.index(goid)]
+
+    def namespace(self, goid):
+        return self.ns_names[self.ns_codes[self.index(goid)]]
+
+    def count(self, goid, key):
+        return self.counts[key][self.index(goid)]
+
+    def node(self, goid):
+        """
+        Returns the attributes of a node as a dictionary.
+        """
+        idx = self.index(goid)
+        attrs = dict(id=goid, name=self.names[idx], namespace=self.ns_names[self.ns_codes[idx]])
+        for key, values in self.counts.items():
+            attrs[key] = values[idx]
+        return attrs
+
+    def walk(self, indices, step):
+        """
+        Returns all nodes reachable from the start nodes, excluding the start nodes themselves.
+        """
+        seen = set()
+        queue = deque(indices)
+        while queue:
+            for nxt in step(queue.popleft()):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    queue.append(nxt)
+        return seen
+
+    def closure(self):
+        """
+        Computes the sorted ancestors of every node as offset/value arrays.
+        """
+        rows = [()] * self.size
+        for idx in self.topological_order():
+            parents = self.parents(idx)
+            anc = set(parents)
+            for parent in parents:
+                anc.update(rows[parent])
+            rows[idx] = sorted(anc)
+        ptr, values = uint_array([0]), uint_array()
+        for row in rows:
+            values.extend(row)
+            ptr.append(len(values))
+        return ptr, values
+
+    def init_closure(self):
+        if self.anc_ptr is None:
+            self.anc_ptr, self.anc_idx = self.closure()
+
+    def ancestor_indices(self, idx):
+        """
+        Returns the sorted ancestors of a node.
+        """
+        self.init_closure()
+        return self.anc_idx[self.anc_ptr[idx]:self.anc_ptr[idx + 1]]
+
+    def ancestor_union(self, indices):
+        """
+        Returns the union of the ancestors of the nodes.
+        """
+        result = set()
+        for idx in indices:
+            result.update(self.ancestor_indices(idx))
+        return result
+
+    def is_ancestor(self, anc, idx):
+        """
+        True if the node anc is an ancestor of node idx.
+        """
+        row = self.ancestor_indices(idx)
+        pos = bisect_left(row, anc)
+        return pos < len(row) and row[pos] == anc
+
+    def ancestors(self, goid):
+        return set(self.ids[x] for x in self.ancestor_indices(self.index(goid)))
+
+    def descendants(self, goid):
+        return set(self.ids[x] for x in self.walk([self.index(goid)], self.children))
+
+    def topological_order(self, indices=None):
+        """
+        Returns the node indices parents first. Restricted to the indices if given.
+        """
+        if indices is None and self.topo is not None:
+            return list(self.topo)
+        members = set(range(self.size)) if indices is None else set(indices)
+        degree = {idx: sum(1 for x in self.parents(idx) if x in members) for idx in members}
+        queue = deque(sorted(idx for idx, value in degree.items() if value == 0))
+        order = []
+        while queue:
+            idx = queue.popleft()
+            order.append(idx)
+            for child in self.children(idx):
+                if child in members:
+                    degree[child] -= 1
+                    if degree[child] == 0:
+                        queue.append(child)
+        return order
+
+    def topological_sort(self):
+        return [self.ids[x] for x in self.topological_order()]
+
+    def init_order(self):
+        """
+        Computes the topological order and the depth of each node.
+
+        The depth of a node is the length of the longest path from a root.
+        """
+        if self.topo is None:
+            self.topo = uint_array(self.topological_order())
+        if self.depths is None:
+            depths = uint_array([0]) * self.size
+            for idx in self.topo:
+                for parent in self.parents(idx):
+                    depths[idx] = max(depths[idx], depths[parent] + 1)
+            self.depths = depths
+
+    def depth(self, goid):
+        self.init_order()
+        return self.depths[self.index(goid)]
+
+    def overlay(self, counts):
+        """
+        Returns a copy of the graph that shares the arrays but has its own counts.
+        """
+        graph = copy.copy(self)
+        graph.counts = counts
+        graph.base = self.base or self
+        return graph
+
+    def subgraph(self, goids):
+        """
+        Returns the subgraph induced by the GO ids.
+        """
+        indices = filter(lambda x: x is not None, map(self.index, goids))
+        return SubGraph(self, indices)
+
+    def to_networkx(self):
+        """
+        Returns the graph as a networkx DiGraph.
+        """
+        return SubGraph(self, range(self.size)).to_networkx()
+
+
+def fingerprint(ids):
+    """
+    Returns a hash of the term ids in order.
+    """
+    digest = hashlib.sha1(usedforsecurity=False)
+    for goid in ids:
+        digest.update(goid.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def shared(key, build, counts):
+    """
+    Returns the shared graph for a key with the counts as an overlay.
+
+    The graph is built and registered on first use. The ancestors and the
+    topological order are computed before sharing, so that the overlays
+    do not compute their own copies.
+    """
+    with LOCK:
+        graph = REGISTRY.get(key)
+        if graph is None:
+            graph = build()
+            graph.init_closure()
+            graph.init_order()
+            REGISTRY[key] = graph
+    return graph.overlay(counts)
+
+
+class TermMap(Mapping):
+    """
+    A read-only mapping of GO ids to term dictionaries generated from a graph.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, goid):
+        graph = self.graph
+        idx = graph.index(goid)
+        if idx is None:
+            raise KeyError(goid)
+        code = graph.ns_names[graph.ns_codes[idx]]
+        term = dict(id=goid, name=graph.names[idx], namespace=utils.NAMESPACE_MAP_REV.get(code, code))
+        parents = graph.parents(idx)
+        if len(parents):
+            term["is_a"] = [graph.ids[x] for x in parents]
+        for key, values in graph.counts.items():
+            term[key] = values[idx]
+        return term
+
+    def __contains__(self, goid):
+        return self.graph.index(goid) is not None
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+
+class SubGraph:
+    """
+    A subset of the nodes of an ontology graph. Nodes are sorted by GO id.
+    """
+    __slots__ = ("graph", "members", "order")
+
+    def __init__(self, graph, indices, order=None):
+        self.graph = graph
+        self.members = set(indices)
+
+        # The order may be given when the members are already sorted.
+        self.order = sorted(self.members, key=lambda x: graph.ids[x]) if order is None else order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, goid):
+        return self.graph.index(goid) in self.members
+
+    def __iter__(self):
+        ids = self.graph.ids
+        for idx in self.order:
+            yield ids[idx]
+
+    def __str__(self):
+        return f"SubGraph with {self.number_of_nodes():,d} nodes and {self.number_of_edges():,d} edges"
+
+    def nodes(self):
+        return list(self)
+
+    def number_of_nodes(self):
+        return len(self.order)
+
+    def children(self, idx):
+        return [x for x in self.graph.children(idx) if x in self.members]
+
+    def parents(self, idx):
+        return [x for x in self.graph.parents(idx) if x in self.members]
+
+    def edges(self):
+        """
+        Returns the edges as (parent, child) GO id pairs.
+        """
+        ids = self.graph.ids
+        return [(ids[idx], ids[child]) for idx in self.order for child in self.children(idx)]
+
+    def number_of_edges(self):
+        return sum(len(self.children(idx)) for idx in self.order)
+
+    def successors(self, goid):
+        return [self.graph.ids[x] for x in self.children(self.graph.index(goid))]
+
+    def predecessors(self, goid):
+        return [self.graph.ids[x] for x in self.parents(self.graph.index(goid))]
+
+    def in_degree(self, goid):
+        return len(self.parents(self.graph.index(goid)))
+
+    def out_degree(self, goid):
+        return len(self.children(self.graph.index(goid)))
+
+    def roots(self):
+        return [self.graph.ids[idx] for idx in self.order if not self.parents(idx)]
+
+    def topological_order(self):
+        return self.graph.topological_order(self.order)
+
+    def to_networkx(self):
+        """
+        Returns the subgraph as a networkx DiGraph.
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        for goid in self:
+            graph.add_node(goid, **self.graph.node(goid))
+        graph.add_edges_from(self.edges())
+        return graph
@@ -0,0 +1,204 @@
+"""
+Serves the annotate and tree commands over a Unix socket.
+
+The daemon keeps the indexes and their graphs loaded, the command line
+forwards its requests to it when it runs and skips the loading of the
+index altogether.
+
+The client sends one JSON line with the request. The daemon answers with
+one JSON line with the status of the run, followed by the CSV or DOT
+output that is streamed until the connection closes.
+"""
+import codecs
+import json
+import os
+import socket
+import socketserver
+from pathlib import Path
+
+from genescape import gs_index, resources, utils
+
+# The environment variable that sets the socket path.
+SOCKET_ENV = "GENESCAPE_SOCKET"
+
+# The name of the socket in the storage directory.
+SOCKET_NAME = "genescape.sock"
+
+# The size of the chunks the output is streamed in.
+CHUNK = 64 * 1024
+
+# The commands served by the daemon.
+CMD_ANNOTATE, CMD_TREE = "annotate", "tree"
+
+
+def socket_path(config):
+    """
+    Returns the path of the socket, from the environment or in the storage directory.
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if path is not None:
+        return path
+    return str(resources.get_storage_dir(config) / SOCKET_NAME)
+
+
+def run_request(req):
+    """
+    Runs a request. Returns the status and the output text.
+    """
+    from genescape import gs_graph
+
+    if not os.path.isfile(req["idx"]):
+        msg = f"file not found: {req['idx']}"
+        raise ValueError(msg)
+
+    idg = gs_graph.load_index_graph(req["idx"])
+
+    run, coverage = gs_graph.annotate(idg, targets=req["targets"], root=req.get("root", utils.NS_ALL),
+                                      coverage=req.get("coverage", 0), pattern=req.get("pattern", ""),
+                                      max_nodes=req.get("max_nodes", 0), max_edges=req.get("max_edges", 0))
+
+    if req["cmd"] == CMD_TREE:
+        pg = run.as_pydot()
+        pg.set_graph_defaults()
+        text = pg.to_string()
+    else:
+        text = run.as_csv()
+
+    head = dict(status="ok", coverage=coverage, nodes=run.tree.number_of_nodes(),
+                edges=run.tree.number_of_edges(), errors=run.errors)
+
+    return head, text
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    Answers one request per connection.
+    """
+
+    def handle(self):
+        req = dict()
+        try:
+            req = json.loads(self.rfile.readline())
+            head, text = run_request(req)
+            utils.info(f"{req['cmd']}: {len(req['targets'])} targets, {head['nodes']} nodes")
+        except SystemExit:
+            # The errors reported with utils.stop are in the log of the daemon.
+            head, text = dict(status="error", message=f"invalid index: {req.get('idx')}"), ""
+        except Exception as exc:
+            utils.error(f"request failed: {exc}")
+            head, text = dict(status="error", message=str(exc)), ""
+
+        self.wfile.write((json.dumps(head) + "\n").encode("utf-8"))
+
+        data = text.encode("utf-8")
+        for start in range(0, len(data), CHUNK):
+            self.wfile.write(data[start:start + CHUNK])
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def is_running(path):
+    """
+    True if a daemon listens on the socket.
+    """
+    sock = connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def connect(path):
+    """
+    Returns a socket connected to the daemon, None when it does not run.
+    """
+    if not path or not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def serve(path, idx_fnames):
+    """
+    Loads the indexes then serves requests on the socket until interrupted.
+    """
+    from genescape import gs_graph
+
+    if is_running(path):
+        utils.stop(f"daemon already running: {path}")
+
+    # Keep the indexes warm.
+    for fname in idx_fnames:
+        idg = gs_graph.load_index_graph(str(Path(fname).resolve()))
+        utils.info(str(idg.idx))
+
+    # Swap in the indexes whose files change.
+    watcher = gs_index.Watcher(idx_fnames).start()
+
+    # Remove the socket left by a daemon that did not shut down.
+    if os.path.exists(path):
+        os.remove(path)
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    # Only the owner may connect, the socket is created with these permissions.
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+
+    utils.info(f"listening: {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        server.server_close()
+        os.remove(path)
+
+
+def forward(path, out, **req):
+    """
+    Forwards a request to the daemon and streams the output into a file name or a text stream.
+
+    Returns the status of the run, None when no daemon runs.
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    req["idx"] = str(Path(req["idx"]).resolve())
+
+    with sock, sock.makefile("rb") as stream:
+        sock.sendall((json.dumps(req) + "\n").encode("utf-8"))
+        line = stream.readline()
+        if not line:
+            utils.stop(f"daemon: no response from {path}")
+
+        head = json.loads(line)
+        if head["status"] != "ok":
+            utils.stop(f"daemon: {head['message']}")
+
+        # The file is opened once the run succeeded.
+        fp = open(out, "w") if isinstance(out, (str, Path)) else out
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in iter(lambda: stream.read(CHUNK), b""):
+            fp.write(decoder.decode(chunk))
+        fp.write(decoder.decode(b"", final=True))
+
+        if fp is not out:
+            fp.close()
+
+    utils.info(f"daemon: {path}")
+
+    return head
@@ -1,15 +1,20 @@
-import sys, json, os
+import io
+import json
+import os
+import sys
+import tempfile
 from pathlib import Path
+
 import click
-from genescape import __version__
-from genescape import resources, utils, gs_graph, gs_index
-from pprint import pprint
-from threading import Timer
-import webbrowser
+
+from genescape import __version__, gs_index, gs_server, resources, utils
 
 # Valid choices for root
 ROOT_CHOICES = [utils.NS_BP, utils.NS_MF, utils.NS_CC, utils.NS_ALL]
 
+# Valid choices for the index format
+FORMAT_CHOICES = [gs_index.FORMAT_JSON, gs_index.FORMAT_BIN]
+
 HELP = f"Gene function visualization (v{__version__})."
 
 
@@ -62,6 +67,10 @@ def run():
 @click.option("-m", "--match", "match", metavar="REGEX", default='', help="Regular expression match on function")
 @click.option("-c", "--mincov", "coverage", metavar="INT", default=0, type=int,
               help="The minimal coverage for a GO term (1)")
+@click.option("-N", "--maxnodes", "max_nodes", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many nodes")
+@click.option("-E", "--maxedges", "max_edges", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many edges")
 @click.option("-t", "--test", "test", is_flag=True, help="Run with test data")
 @click.option('-r', '--root',
               type=click.Choice(ROOT_CHOICES, case_sensitive=False),
@@ -70,7 +79,8 @@ def run():
               )
 @click.option("-v", "verbose", is_flag=True, help="Verbose output.")
 @click.help_option("-h", "--help")
-def annotate(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False, test=False, match="", coverage=0):
+def annotate(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False, test=False, match="", coverage=0,
+             max_nodes=0, max_edges=0):
     """
     Generates GO terms annotations for a list of genes.
     """
@@ -83,19 +93,27 @@ def annotate(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=Fal
 
     targets = utils.parse_genes(fname)
 
-    idg = gs_graph.load_index_graph(idx_fname)
+    # A running daemon has the index loaded already.
+    head = gs_server.forward(gs_server.socket_path(res.config), out_fname or sys.stdout, cmd=gs_server.CMD_ANNOTATE,
+                             idx=idx_fname, targets=targets, root=root, coverage=coverage, pattern=match,
+                             max_nodes=max_nodes, max_edges=max_edges)
+    if head:
+        utils.info(f"graph: {head['nodes']} nodes, {head['edges']} edges")
+        utils.check_budget(head["nodes"], head["edges"], max_nodes=max_nodes, max_edges=max_edges)
+        return
 
-    # Estimate the count if not provided
-    if coverage < 1:
-        coverage = gs_graph.estimate(idg, targets=targets, pattern=match, root=root)
+    from genescape import gs_graph
 
-    run = gs_graph.subgraph(idg, targets=targets, root=root, coverage=coverage, pattern=match)
+    idg = gs_graph.load_index_graph(idx_fname)
 
-    utils.info(f"graph: {run.tree.number_of_nodes()} nodes, {run.tree.number_of_edges()} edges")
+    # Estimate the count if not provided, the tree is built from the same mapping.
+    run, coverage = gs_graph.annotate(idg, targets=targets, root=root, coverage=coverage, pattern=match,
+                                      max_nodes=max_nodes, max_edges=max_edges)
 
-    df = run.as_df()
+    utils.info(f"graph: {run.tree.number_of_nodes()} nodes, {run.tree.number_of_edges()} edges")
 
-    text = df.to_csv(index=False)
+    # The table is written without pandas.
+    text = run.as_csv()
 
     if out_fname:
         utils.info(f"output: {out_fname}")
@@ -112,6 +130,10 @@ def annotate(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=Fal
 @click.option("-m", "--match", "match", metavar="REGEX", default='', help="Regular expression match on function")
 @click.option("-c", "--mincov", "coverage", metavar="INT", default=0, type=int,
               help="The minimal coverage for a GO term (1)")
+@click.option("-N", "--maxnodes", "max_nodes", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many nodes")
+@click.option("-E", "--maxedges", "max_edges", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many edges")
 @click.option("-t", "--test", "test", is_flag=True, help="Run with test data")
 @click.option('-r', '--root',
               type=click.Choice(ROOT_CHOICES, case_sensitive=False),
@@ -120,7 +142,8 @@ def annotate(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=Fal
               )
 @click.option("-v", "verbose", is_flag=True, help="Verbose output.")
 @click.help_option("-h", "--help")
-def tree(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False, test=False, match="", coverage=0):
+def tree(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False, test=False, match="", coverage=0,
+         max_nodes=0, max_edges=0):
     """
     Generates GO terms annotations for a list of genes.
     """
@@ -133,13 +156,29 @@ def tree(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False,
 
     targets = utils.parse_genes(fname)
 
-    idg = gs_graph.load_index_graph(idx_fname)
+    from genescape import gs_graph
+
+    # A running daemon returns the tree in DOT format, other formats are rendered here.
+    text = io.StringIO()
+    head = gs_server.forward(gs_server.socket_path(res.config), out_fname if out_fname.endswith(".dot") else text,
+                             cmd=gs_server.CMD_TREE, idx=idx_fname, targets=targets, root=root, coverage=coverage,
+                             pattern=match, max_nodes=max_nodes, max_edges=max_edges)
+    if head:
+        utils.info(f"graph: {head['nodes']} nodes, {head['edges']} edges")
+        utils.check_budget(head["nodes"], head["edges"], max_nodes=max_nodes, max_edges=max_edges)
+        if not out_fname.endswith(".dot"):
+            import pydot
+            pg = pydot.graph_from_dot_data(text.getvalue())[0]
+            gs_graph.save_graph(pg, fname=out_fname, imgsize=4096)
+        else:
+            utils.info(f"file: {out_fname}")
+        return
 
-    # Estimate the count if not provided
-    if coverage < 1:
-        coverage = gs_graph.estimate(idg, targets=targets, pattern=match, root=root)
+    idg = gs_graph.load_index_graph(idx_fname)
 
-    run = gs_graph.subgraph(idg, targets=targets, root=root, coverage=coverage, pattern=match)
+    # Estimate the count if not provided, the tree is built from the same mapping.
+    run, coverage = gs_graph.annotate(idg, targets=targets, root=root, coverage=coverage, pattern=match,
+                                      max_nodes=max_nodes, max_edges=max_edges)
 
     pg = run.as_pydot()
 
@@ -148,18 +187,68 @@ def tree(fname, out_fname='', idx_fname=None, root=utils.NS_ALL, verbose=False,
     gs_graph.save_graph(pg, fname=out_fname, imgsize=4096)
 
 
+@run.command()
+@click.argument("fname", default=None, required=False)
+@click.option("-i", "--idx", "idx_fname", metavar="TEXT", help="Genescape index file.")
+@click.option("-o", "--out", "out", default="batch", metavar="TEXT",
+              help="Output directory, or a .csv or .jsonl file (batch)")
+@click.option("-j", "--jobs", "jobs", metavar="INT", default=1, type=int, help="Parallel jobs (1)")
+@click.option("-m", "--match", "match", metavar="REGEX", default='', help="Regular expression match on function")
+@click.option("-c", "--mincov", "coverage", metavar="INT", default=0, type=int,
+              help="The minimal coverage for a GO term (1)")
+@click.option("-N", "--maxnodes", "max_nodes", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many nodes")
+@click.option("-E", "--maxedges", "max_edges", metavar="INT", default=0, type=int,
+              help="Pick the coverage for at most this many edges")
+@click.option("-d", "--dot", "dot", is_flag=True, help="Write the trees as DOT files as well")
+@click.option('-r', '--root',
+              type=click.Choice(ROOT_CHOICES, case_sensitive=False),
+              default=utils.NS_ALL,
+              help='Select a category: BP, MF, CC, or ALL.',
+              )
+@click.help_option("-h", "--help")
+def batch(fname, out="batch", idx_fname=None, jobs=1, root=utils.NS_ALL, match="", coverage=0, max_nodes=0,
+          max_edges=0, dot=False):
+    """
+    Annotates many gene lists: a directory of lists, a GMT, CSV or JSON lines file.
+    """
+    from genescape import gs_batch
+
+    res = resources.init()
+    idx_fname = idx_fname or res.INDEX_FILE
+
+    if not fname or not os.path.exists(fname):
+        utils.stop(f"input not found: {fname}")
+
+    gs_batch.run_batch(fname, idx_fname=idx_fname, out=out, jobs=jobs, root=root, coverage=coverage,
+                       pattern=match, max_nodes=max_nodes, max_edges=max_edges, dot=dot)
+
+
 @run.command()
 @click.option("-b", "--obo", "obo_fname", help="Input OBO file (go-basic.obo)")
 @click.option("-g", "--gaf", "gaf_fname", help="Input GAF file (goa_human.gaf.gz)")
 @click.option("-i", "--idx", "idx_fname", default="genescape.index.gz", help="Output index file (genescape.json.gz)")
 @click.option("-s", "--stats", "stats", is_flag=True, help="Print the index stats")
 @click.option("-d", "--dump", "dump", is_flag=True, help="Print the index file to the screen")
+@click.option("-f", "--format", "fmt", type=click.Choice(FORMAT_CHOICES), default=gs_index.FORMAT_JSON,
+              help="Output index format (json)")
+@click.option("-c", "--convert", "src_fname", metavar="TEXT", help="Convert an existing index into the output format")
+@click.option("-j", "--jobs", "jobs", metavar="INT", default=1, type=int,
+              help="Parallel jobs to parse the GAF file (not with --mem), or to build the manifest indexes (1)")
+@click.option("-m", "--manifest", "manifest", metavar="TOML", help="Build all indexes listed in a manifest file")
+@click.option("-M", "--mem", "mem", metavar="MB", type=float,
+              help="Build a binary index out of core, with a memory budget in MB")
+@click.option("-T", "--tmpdir", "tmpdir", metavar="DIR", help="Directory for the temporary files")
+@click.option("-n", "--nocache", "nocache", is_flag=True, help="Parse the OBO file without the compiled cache")
 @click.option("-t", "--test", "test", is_flag=True, help="Run with test data")
 @click.help_option("-h", "--help")
-def build(idx_fname=None, obo_fname=None, gaf_fname=None, stats=False, dump=False, test=False):
+def build(idx_fname=None, obo_fname=None, gaf_fname=None, stats=False, dump=False, fmt=gs_index.FORMAT_JSON,
+          src_fname=None, jobs=1, manifest=None, mem=None, tmpdir=None, nocache=False, test=False):
     """
     Builds index file from an OBO and GAF file.
     """
+    from genescape import gs_graph, gs_obo
+
     res = resources.init()
 
     if stats:
@@ -169,10 +258,36 @@ def build(idx_fname=None, obo_fname=None, gaf_fname=None, stats=False, dump=Fals
 
     if dump:
         idg = gs_graph.load_index_graph(idx_fname)
-        text = json.dumps(idg.idx.data, indent=4)
+        text = json.dumps(idg.idx.data, indent=4, default=dict)
         print(text)
         return
 
+    # Convert an existing index to a different format.
+    if src_fname:
+        check_files([('convert', src_fname)])
+        idx = gs_index.load_index(src_fname)
+        gs_index.save_index(idx, idx_fname, fmt=fmt)
+        size = Path(idx_fname).stat().st_size / 1024 / 1024
+        utils.info(f"index: {idx_fname} ({size:.2f} MB, {fmt})")
+        return
+
+    # The compiled ontology files are kept in the storage directory.
+    cache_dir = None if nocache else resources.get_storage_dir(res.config) / gs_obo.CACHE_DIR
+
+    # Build the indexes listed in a manifest.
+    if manifest:
+        from genescape import gs_manifest
+        check_files([('manifest', manifest)])
+        obo, genomes = gs_manifest.read_manifest(manifest)
+        obo_fname = obo_fname or obo
+        check_files([('obo', obo_fname)] + [('gaf', entry['gaf']) for entry in genomes])
+
+        # The workers share the compiled ontology.
+        with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+            gs_manifest.build_all(genomes, obo_fname=obo_fname, cache_dir=cache_dir or tmp, jobs=jobs, fmt=fmt,
+                                  mem=mem, tmpdir=tmpdir)
+        return
+
     # Runs with test data
     if test:
         obo_fname = res.OBO_FILE
@@ -188,10 +303,21 @@ def build(idx_fname=None, obo_fname=None, gaf_fname=None, stats=False, dump=Fals
     utils.info(f"obo: {obo_fname}")
     utils.info(f"gaf: {gaf_fname}")
     utils.info(f"index: {idx_fname}")
-    idx = gs_index.build_index(obo_fname=obo_fname, gaf_fname=gaf_fname, fname=idx_fname)
-    gs_index.save_index(idx, idx_fname)
 
-    utils.info(str(idx))
+    # The out of core build streams the GAF file through sorted runs on disk.
+    if mem:
+        if fmt != gs_index.FORMAT_BIN:
+            utils.stop("the --mem option requires --format bin")
+        if jobs > 1:
+            utils.stop("the --mem option parses the GAF file in a single job, drop --jobs")
+        from genescape import gs_build
+        gs_build.build_index(obo_fname=obo_fname, gaf_fname=gaf_fname, fname=idx_fname, mem=mem, tmpdir=tmpdir,
+                             cache_dir=cache_dir)
+    else:
+        idx = gs_index.build_index(obo_fname=obo_fname, gaf_fname=gaf_fname, fname=idx_fname, jobs=jobs,
+                                   tmpdir=tmpdir, cache_dir=cache_dir)
+        gs_index.save_index(idx, idx_fname, fmt=fmt)
+        utils.info(str(idx))
 
     # Print file size in megabytes
     size = Path(idx_fname).stat().st_size / 1024 / 1024
@@ -200,17 +326,40 @@ def build(idx_fname=None, obo_fname=None, gaf_fname=None, stats=False, dump=Fals
 
 
 
+@run.command()
+@click.option("-s", "--socket", "sock", metavar="PATH", help="The socket path (storage directory)")
+@click.option("-i", "--idx", "idx_fnames", metavar="TEXT", multiple=True,
+              help="Index files to load at startup, may be repeated (default index)")
+@click.help_option("-h", "--help")
+def serve(sock=None, idx_fnames=()):
+    """
+    Runs a daemon that keeps the indexes loaded for the annotate and tree commands.
+    """
+    res = resources.init()
+
+    sock = sock or gs_server.socket_path(res.config)
+    idx_fnames = idx_fnames or [res.INDEX_FILE]
+
+    check_files([('idx', fname) for fname in idx_fnames])
+
+    gs_server.serve(sock, idx_fnames=idx_fnames)
+
+
 @run.command()
 @click.option("-i", "--idx", "idx_fname", default="", help="Index file")
 @click.option("--host", "host", default="127.0.0.1", help="Hostname to bind to")
 @click.option("--port", "port", default=8000, type=int, help="Port number")
+@click.option("-w", "--workers", "workers", default=1, type=int, help="Worker processes (1)")
 @click.option("-r", "--reload", "reload", is_flag=True, help="Reload the webserver on changes")
 @click.option("-t", "--test", "test", is_flag=True, help="Test mode (autgenerates gene lists)")
 @click.help_option("-h", "--help")
-def web(idx_fname='', host='localhost', port=8000, reload=False, test=False):
+def web(idx_fname='', host='localhost', port=8000, workers=1, reload=False, test=False):
     """
     Runs the web interface
     """
+    import webbrowser
+    from threading import Timer
+
     import shiny
 
     # Insert the index into the environment.
@@ -232,8 +381,11 @@ def web(idx_fname='', host='localhost', port=8000, reload=False, test=False):
     # Pops a web browser
     Timer(1, open_browser).start()
 
+    # The worker processes share the published indexes.
+    kwargs = dict(workers=workers) if workers > 1 else dict()
+
     # Run the server
-    shiny.run_app("genescape.shiny.tree.app:app", host=host, port=port, reload=reload)
+    shiny.run_app("genescape.shiny.tree.app:app", host=host, port=port, reload=reload, **kwargs)
 
 
 if __name__ == '__main__':
@@ -15,66 +15,49 @@ from pprint import pprint
 
 CURR_DIR = Path(os.path.dirname(__file__))
 
-CACHE = {}
 
+def lazy_path(name):
+    """
+    A resource file attribute, resolved on first access.
+    """
+    return property(lambda self: self.get(name))
 
-def cache(key, func):
-    global CACHE
-
-    #key = str(key)
-
-    utils.debug(f"cache: {key}")
-
-    if key not in CACHE:
-        CACHE[key] = func()
 
-    return CACHE[key]
+class Resource:
 
+    # The ontology and the GAF demo data.
+    OBO_FILE = lazy_path("go-basic.obo.gz")
+    GAF_FILE = lazy_path("goa_human.gaf.gz")
 
-def clear_cache():
-    global CACHE
-    CACHE = {}
+    # The test data files.
+    TEST_GOIDS = lazy_path("test_goids.txt")
+    TEST_GENES = lazy_path("test_genes.txt")
+    TEST_INPUT_CSV = lazy_path("test_input.csv")
+    TEST_INPUT_JSON = lazy_path("test_input.json")
 
-
-class Resource:
+    # The CSS and JS files.
+    GENESCAPE_CSS = lazy_path("genescape.css")
+    GENESCAPE_JS = lazy_path("genescape.js")
+    VIZ_JS = lazy_path("viz-standalone.js")
 
     def __init__(self, config):
 
         # Save the configuration.
         self.config = config
 
-        # Store the files separately.
+        # The file records by target, the paths are resolved when first used.
         self.files = dict()
+        self.paths = dict()
 
         # Populate the resource files.
         targets = config.get("files", [])
         for value in targets:
-            self.files[value["target"]] = value["path"]
-
-        def get(name):
-            return self.files.get(name, name)
-
-        self.OBO_FILE = get("go-basic.obo.gz")
-
-        # Initialize test data files.
-        self.TEST_GOIDS = get("test_goids.txt")
-        self.TEST_GENES = get("test_genes.txt")
-        self.TEST_INPUT_CSV = get("test_input.csv")
-        self.TEST_INPUT_JSON = get("test_input.json")
-
-        # The GAF demo data.
-        self.GAF_FILE = get("goa_human.gaf.gz")
-
-        # The CSS and JS files.
-        self.GENESCAPE_CSS = get("genescape.css")
-        self.GENESCAPE_JS = get("genescape.js")
-        self.VIZ_JS = get("viz-standalone.js")
+            self.files[value["target"]] = value
 
         self.INDEX_MAP = {}
 
-
         def pieces(elem):
-            return (elem.get("code", "CODE"), elem.get("label", "LABEL"), elem.get("path", "PATH"))
+            return (elem.get("code", "CODE"), elem.get("label", "LABEL"), elem.get("target", "PATH"))
 
         values = self.config.get("files", [])
         values = filter(lambda x: x.get("type", "") == "index", values)
@@ -85,15 +68,33 @@ class Resource:
         # Default code is the first file.
         self.DEFAULT_CODE = list(self.INDEX_MAP.keys())[0]
 
-        # The default index.
-        self.INDEX_FILE = self.find_index()
+    @property
+    def INDEX_FILE(self):
+        """
+        The default index.
+        """
+        return self.find_index()
+
+    def get(self, name):
+        """
+        Returns the path to a resource file, names that are not listed are returned as they are.
+        """
+        if name not in self.files:
+            return name
+
+        path = self.paths.get(name)
+        if path is None:
+            value = self.files[name]
+            path = self.paths[name] = get_path(package=value.get("package"), target=value.get("target"),
+                                               subdir=value.get("subdir", []), config=self.config)
+        return path
 
     def find_index(self, code=None):
         code = code or self.DEFAULT_CODE
         if code not in self.INDEX_MAP:
             pprint(self.INDEX_MAP)
             raise Exception(f"Code not found: {code}")
-        return self.INDEX_MAP[code][2]
+        return self.get(self.INDEX_MAP[code][2])
 
     def index_choices(self):
         choices = dict(map(lambda x: (x[0], x[1]), self.INDEX_MAP.values()))
@@ -164,9 +165,13 @@ def get_storage_dir(config):
     return path
 
 
-def get_path(package='', target='', subdir=None, config=None):
+def get_path(package='', target='', subdir=None, config=None, writable=False):
     """
     Returns a file path to a resource.
+
+    The files of an installed package are used in place. The resources
+    that are not files on disk, or that need to be writable, are copied
+    to the storage directory.
     """
 
     if not target:
@@ -176,6 +181,13 @@ def get_path(package='', target='', subdir=None, config=None):
     if not package:
         return Path(target)
 
+    # The resource in the package.
+    src = rsc.files(package).joinpath(target)
+
+    # Read the installed files directly.
+    if not writable and isinstance(src, Path) and src.is_file():
+        return src
+
     # Set a sane default for the configuration.
     config = config or {}
 
@@ -194,12 +206,18 @@ def get_path(package='', target='', subdir=None, config=None):
         path.parent.mkdir(parents=True, exist_ok=True)
 
     # Copy the resource to the target directory if it is not there or newer.
-    with rsc.files(package).joinpath(target).open('rb') as src:
-        # The condition to copy the resource
-        cond = not os.path.isfile(path) or os.path.getmtime(src.fileno()) > os.path.getmtime(path)
+    with src.open('rb') as stream:
+        # The condition to copy the resource, streams without a file (zipped packages) are copied once.
+        try:
+            cond = not os.path.isfile(path) or os.path.getmtime(stream.fileno()) > os.path.getmtime(path)
+        except OSError:
+            cond = not os.path.isfile(path)
         if cond:
-            with open(path, 'wb') as dst:
-                shutil.copyfileobj(src, dst)
+            # Concurrent copies replace the file whole.
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp, 'wb') as dst:
+                shutil.copyfileobj(stream, dst)
+            os.replace(tmp, path)
             utils.info(f'copy: {path}')
 
     return path
@@ -207,23 +225,12 @@ def get_path(package='', target='', subdir=None, config=None):
 
 def init(config=None):
     """
-    Initializes resources from a configuration file.
+    Initializes resources from a configuration file. The files are located when first used.
     """
 
     # Initialize the configuration.
     config = config or get_config()
 
-    # Initialize the targets in the config
-    targets = config.get("files", [])
-
-    # Adds a path to each target.
-    for value in targets:
-        package = value.get("package", None)
-        target = value.get("target", None)
-        subdir = value.get("subdir", [])
-        path = get_path(package=package, target=target, subdir=subdir, config=config)
-        value['path'] = path
-
     res = Resource(config)
 
     return res
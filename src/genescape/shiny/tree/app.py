@@ -1,14 +1,16 @@
 from shiny import reactive
 from shiny import App, render, ui
-import asyncio, os, time
+import asyncio, contextlib, itertools, os, time
+from concurrent.futures import ThreadPoolExecutor
 from genescape import icons
-from genescape import __version__, gs_graph, utils, resources
+from genescape import __version__, gs_cache, gs_graph, gs_index, utils, resources
 import pandas as pd
 from pathlib import Path
 from random import shuffle
 
 from starlette.applications import Starlette
-from starlette.routing import Mount
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
 from starlette.staticfiles import StaticFiles
 
 # Load the default resources.
@@ -53,6 +55,52 @@ SIDEBAR_WIDTH = res.config.get("SIDEBAR_WIDTH", 300)
 # Default sidebar background color.
 SIDEBAR_BG = res.config.get("SIDEBAR_WIDTH", "#f9f9f9")
 
+# The number of trees computed at the same time.
+WORKERS = int(os.environ.get("GENESCAPE_WORKERS", res.config.get("WORKERS", 4)))
+
+# Runs the CPU bound pipeline off the event loop.
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="genescape")
+
+# The results of the recent queries, shared by all sessions.
+RESULTS = gs_cache.LRUCache(maxsize=res.config.get("RESULT_CACHE_SIZE", gs_cache.MAXSIZE),
+                            maxbytes=res.config.get("RESULT_CACHE_MB", 256) * 1024 * 1024)
+
+# The memory budget of the loaded indexes.
+gs_index.INDEXES.maxbytes = res.config.get("INDEX_CACHE_MB", 4096) * 1024 * 1024
+
+# The worker processes share the indexes published as binary files in the storage directory.
+if res.config.get("SHARED_INDEX", True) and not gs_index.SHARED_DIR:
+    gs_index.SHARED_DIR = str(resources.get_storage_dir(res.config) / "shared")
+
+# The sessions of the recent gene lists, re-filtered without mapping the genes again.
+SESSIONS = gs_cache.LRUCache(maxsize=res.config.get("SESSION_CACHE_SIZE", 16),
+                             maxbytes=res.config.get("SESSION_CACHE_MB", 64) * 1024 * 1024)
+
+# The tree size budget for the estimated coverage.
+MAX_NODES = res.config.get("MAX_NODES", 0)
+MAX_EDGES = res.config.get("MAX_EDGES", 0)
+
+# The indexes loaded at startup, the default index first.
+WARMUP = res.config.get("WARMUP", list(DATABASE_CHOICES))
+
+# The number of indexes loaded at the same time at startup.
+WARMUP_WORKERS = res.config.get("WARMUP_WORKERS", 2)
+
+# The startup loads by index code.
+WARMING = dict()
+
+# The seconds between the checks for changed index files, 0 to turn off the reloads.
+RELOAD_INTERVAL = res.config.get("RELOAD_INTERVAL", gs_index.WATCH_INTERVAL)
+
+# The progress messages for the stages of the pipeline.
+STAGE_MESSAGES = {
+    gs_graph.STAGE_INDEX: "Loading the index",
+    gs_graph.STAGE_SYMBOLS: "Mapping the genes",
+    gs_graph.STAGE_ANCESTORS: "Collecting the ancestors",
+    gs_graph.STAGE_PROPAGATION: "Propagating the annotations",
+    gs_graph.STAGE_OUTPUT: "Generating the outputs",
+}
+
 # Home page link
 HOME = "https://github.com/ialbert/genescape-central/"
 
@@ -270,6 +318,81 @@ def text2list(text):
     return terms
 
 
+class SupersededError(Exception):
+    """
+    Raised when a newer request of the same session replaces a computation.
+    """
+    pass
+
+
+def compute(idx_fname, targets, root, coverage, pattern, current, progress=None):
+    """
+    Runs the pipeline for a gene list. Stops early when the request is no longer current.
+    """
+
+    def check():
+        if not current():
+            raise SupersededError()
+
+    # Load the index.
+    gs_graph.report(progress, gs_graph.STAGE_INDEX)
+    idg = gs_graph.load_index_graph(idx_fname)
+    utils.debug(str(gs_index.INDEXES))
+
+    # Repeated queries are answered from the cache, keyed by the version of the index that runs them.
+    key = gs_cache.query_key(idx_fname, targets=targets, root=root, mincount=coverage, pattern=pattern,
+                             identity=idg.identity)
+    result = RESULTS.get(key)
+    utils.debug(str(RESULTS))
+    if result is not None:
+        gs_graph.report(progress, gs_graph.STAGE_OUTPUT)
+        return result
+    check()
+
+    # The gene list is mapped once, the filters are applied to the same session.
+    skey = key[:2]
+    gsession = SESSIONS.get(skey)
+    if gsession is None or gsession.idg is not idg:
+        # The outputs are kept in the results, the sessions keep no runs.
+        gsession = gs_graph.Session(idg, targets=targets, progress=progress, runs=0)
+        SESSIONS.put(skey, gsession, nbytes=gsession.nbytes())
+    check()
+
+    notes = []
+
+    # Create the subgraph, the coverage is estimated from the same session when not set.
+    run, cover = gs_graph.annotate(idg, targets=targets, pattern=pattern, root=root, coverage=coverage or 0,
+                                   progress=progress, session=gsession, max_nodes=MAX_NODES,
+                                   max_edges=MAX_EDGES)
+    if not coverage:
+        cover_msg = f"Automatically estimated coverage cutoff: {cover}"
+        notes.append(cover_msg)
+    else:
+        cover_msg = f"Coverage set to {coverage}"
+    check()
+
+    # Get the dataframe
+    gs_graph.report(progress, gs_graph.STAGE_OUTPUT)
+    df = run.as_df()
+
+    # Create the pydot object.
+    pg = run.as_pydot()
+    check()
+
+    # The info messages.
+    info2 = f"Graph: {run.tree.number_of_nodes()} nodes and {run.tree.number_of_edges()} edges."
+    info3 = f"{run.idx}"
+
+    result = dict(df=df, csv=df.to_csv(index=False), dot=str(pg), notes=notes, info=[cover_msg, info2, info3],
+                  errors=run.errors)
+
+    # The size of the result in bytes.
+    nbytes = len(result["csv"]) + len(result["dot"]) + int(df.memory_usage(deep=True).sum())
+    RESULTS.put(key, result, nbytes=nbytes)
+
+    return result
+
+
 def server(input, output, session):
 
     # Runtime info messages
@@ -290,6 +413,63 @@ def server(input, output, session):
     # The dot file as a text (invisible)
     dot_value = reactive.Value("# The dot file will appear here.")
 
+    # Numbers the requests of the session, only the latest one is current.
+    counter = itertools.count(1)
+    latest = [0]
+
+    @reactive.extended_task
+    async def tree_task(params):
+        """
+        Computes the tree in the executor.
+        """
+        token = latest[0] = next(counter)
+
+        def current():
+            return latest[0] == token
+
+        loop = asyncio.get_running_loop()
+
+        # The progress is shown only while the pipeline runs.
+        with ui.Progress(min=0, max=1, session=session) as p:
+
+            def update(stage, fraction):
+                if current():
+                    p.set(fraction, message=STAGE_MESSAGES[stage])
+
+            # The stages are reported from the worker thread.
+            def progress(stage, fraction):
+                loop.call_soon_threadsafe(update, stage, fraction)
+
+            return await loop.run_in_executor(EXECUTOR, lambda: compute(current=current, progress=progress, **params))
+
+    @reactive.effect
+    def show_tree():
+        try:
+            result = tree_task.result()
+        except SupersededError:
+            return
+
+        # Set the dataframe value.
+        df_value.set(result["df"])
+
+        # Set the CSV data.
+        csv_value.set(result["csv"])
+
+        # Set the dot data.
+        dot_value.set(result["dot"])
+
+        # Set the messages.
+        note_list.set(result["notes"])
+        info_list.set(result["info"])
+        error_list.set(result["errors"])
+
+        # The trigger function.
+        async def trigger():
+            await session.send_custom_message("trigger", 1)
+
+        # Send a custom message to trigger the graph rendering.
+        session.on_flushed(trigger, once=True)
+
     @reactive.effect
     @reactive.event(input.submit)
     async def submit():
@@ -298,14 +478,6 @@ def server(input, output, session):
     async def create_tree():
         global res
 
-        limit = 10
-        # Emulate some sort of progress bar
-        with ui.Progress(min=1, max=limit) as p:
-            p.set(message="Generating the image", detail="Please wait...")
-            for i in range(1, limit):
-                p.set(i)
-                await asyncio.sleep(0.1)
-
         coverage = input.coverage()
 
         if coverage:
@@ -325,53 +497,13 @@ def server(input, output, session):
         # The input gene list.
         targets = text2list(input.input_list())
 
-        # Load the index.
-        idg = gs_graph.load_index_graph(idx_fname)
-
         note_list.set([])
         error_list.set([])
 
-        # Guess the coverage
-        if not coverage:
-            coverage = gs_graph.estimate(idg, targets=targets, pattern=pattern, root=root)
-            cover_msg = f"Automatically estimated coverage cutoff: {coverage}"
-            note_list.set([cover_msg])
-        else:
-            cover_msg = f"Coverage set to {coverage}"
-
-        # Create the subgraph.
-        run = gs_graph.subgraph(idg, targets=targets, pattern=pattern, root=root, coverage=coverage)
-
-        # Get the dataframe
-        df = run.as_df()
-
-        # Set the dataframe value.
-        df_value.set(df)
-
-        # Set the CSV data.
-        csv_value.set(df.to_csv(index=False))
-
-        # Create the pydot object.
-        pg = run.as_pydot()
-
-        # Set the dot data.
-        dot_value.set(str(pg))
-
-        # Set the info messages.
-        info2 = f"Graph: {run.tree.number_of_nodes()} nodes and {run.tree.number_of_edges()} edges."
-        info3 = f"{run.idx}"
-        info_list.set([ cover_msg, info2, info3])
-
-        # Set the error message.
-        error_list.set(run.errors)
-
-
-        # The trigger function.
-        async def trigger():
-            await session.send_custom_message("trigger", 1)
-
-        # Send a custom message to trigger the graph rendering.
-        session.on_flushed(trigger, once=True)
+        # A new request supersedes the one in flight.
+        tree_task.cancel()
+        latest[0] = next(counter)
+        tree_task.invoke(dict(idx_fname=idx_fname, targets=targets, root=root, coverage=coverage, pattern=pattern))
 
 
     @render.ui
@@ -402,15 +534,48 @@ def server(input, output, session):
 
     @render.download(filename=lambda: "genescape.csv")
     async def download_csv():
-        await asyncio.sleep(0.5)
         yield csv_value.get()
 
     @render.download(filename=lambda: "genescape.dot.txt")
     async def download_dot():
-        await asyncio.sleep(0.5)
         yield dot_value.get()
 
 
+def warm_up(codes):
+    """
+    Loads the indexes in background threads. Requests for an index being loaded wait for that load.
+    """
+    pool = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup")
+    for code in codes:
+        WARMING[code] = pool.submit(gs_graph.load_index_graph, res.find_index(code))
+    pool.shutdown(wait=False)
+    utils.info(f"warming up: {', '.join(codes)}")
+
+
+def index_status(code):
+    """
+    Returns the status of a startup load. A loaded index may have been evicted from the index cache since.
+    """
+    future = WARMING.get(code)
+    if future is None or not future.done():
+        return "loading"
+    if future.exception():
+        return "failed"
+    key = str(Path(res.find_index(code)).resolve())
+    return "ready" if key in gs_index.INDEXES else "evicted"
+
+
+async def ready(request):
+    """
+    The readiness check: succeeds once the startup loads are done and the indexes are loaded.
+    """
+    indexes = {code: index_status(code) for code in WARMUP}
+    is_ready = all(status == "ready" for status in indexes.values())
+    stats = gs_index.INDEXES.stats()
+    data = dict(ready=is_ready, indexes=indexes, loaded=stats["size"], nbytes=stats["nbytes"])
+    return JSONResponse(data, status_code=200 if is_ready else 503)
+
+
 # The Static app
 app_static = StaticFiles(directory=Path(__file__).parent / "static")
 
@@ -418,13 +583,34 @@ app_static = StaticFiles(directory=Path(__file__).parent / "static")
 app_shiny = App(app_ui, server)
 
 
+@contextlib.asynccontextmanager
+async def lifespan(web):
+
+    # Load the indexes while the server starts.
+    warm_up(WARMUP)
+
+    # Swap in the indexes whose files change.
+    watcher = None
+    if RELOAD_INTERVAL:
+        paths = [res.find_index(code) for code in DATABASE_CHOICES]
+        watcher = gs_index.Watcher(paths, interval=RELOAD_INTERVAL).start()
+
+    yield
+
+    if watcher:
+        watcher.stop()
+
+
 def web_app():
+
     routes = [
+        Route('/ready', ready),
         Mount('/static', app=app_static),
         Mount('/', app=app_shiny)
     ]
 
-    web = Starlette(routes=routes)
+    # The indexes are loaded when the server starts, not when the module is imported.
+    web = Starlette(routes=routes, lifespan=lifespan)
 
     return web
 
@@ -36,25 +36,6 @@ def init_logger(logger):
     logger.addHandler(handler)
 
 
-def memoize(func):
-    storage = {}
-
-    def cache(*args, **kwargs):
-        # Create a key based on the function's arguments
-        key = (args, tuple(kwargs.items()))
-
-        # If the result is already in the cache, return it
-        if key in storage:
-            debug("cache hit")
-            return storage[key]
-
-        # Call the function and store the result in the cache
-        result = func(*args, **kwargs)
-        storage[key] = result
-        return result
-
-    return cache
-
 # Set the log level
 def verbosity(flag=False):
     global logger
@@ -189,6 +170,16 @@ def parse_terms(iterable):
     return data
 
 
+def open_file(fname, mode="rt"):
+    """
+    Opens a file, gzipped or plain, in text mode as UTF-8 unless the mode is binary.
+    """
+    fname = str(fname)
+    if fname.endswith(".gz"):
+        return gzip.open(fname, mode=mode, encoding="UTF-8") if "t" in mode else gzip.open(fname, mode=mode)
+    return open(fname, mode=mode, encoding="UTF-8") if "t" in mode else open(fname, mode=mode)
+
+
 # Attempts to get a stream of lines from a filename or the stdin.
 def get_stream(inp=None):
     stream = []
@@ -271,6 +262,32 @@ def parse_genes(fname):
     return reader
 
 
+def check_budget(nodes, edges, max_nodes=0, max_edges=0):
+    """
+    Warns when a tree is over the node or edge budget, no coverage fits the budget then.
+    """
+    if (max_nodes and nodes > max_nodes) or (max_edges and edges > max_edges):
+        warn(f"the tree has {nodes} nodes, {edges} edges, over the budget of "
+             f"{max_nodes or '-'} nodes, {max_edges or '-'} edges")
+
+
+def bit_count(value):
+    """
+    Returns the number of set bits in an integer.
+    """
+    return bin(value).count("1")
+
+
+def bit_positions(value):
+    """
+    Yields the positions of the set bits in an integer, lowest first.
+    """
+    while value:
+        low = value & -value
+        yield low.bit_length() - 1
+        value ^= low
+
+
 def timer(func):
     """
     Decorator that prints the execution time of the function it decorates.
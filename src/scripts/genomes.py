@@ -1,3 +1,7 @@
+import os, sys
+
+from genescape import resources, gs_obo
+
 GENOMES = [
     ("human", "https://current.geneontology.org/annotations/goa_human.gaf.gz"),
     ("mouse", "https://current.geneontology.org/annotations/mgi.gaf.gz"),
@@ -10,7 +14,44 @@ GENOMES = [
     ("ecoli", "https://current.geneontology.org/annotations/ecocyc.gaf.gz"),
 ]
 
+# The ontology shared by all builds.
+OBO = "obo/go-basic.obo.gz"
+
+
+def compile_obo(obo_fname=OBO):
+    """
+    Compiles the ontology once, the builds load the compiled file from the storage directory.
+    """
+    cache_dir = resources.get_storage_dir(resources.get_config()) / gs_obo.CACHE_DIR
+    path = gs_obo.cache_path(obo_fname, cache_dir)
+    if not path.exists():
+        gs_obo.compile_obo(obo_fname, path)
+    return path
+
+
+def manifest():
+    """
+    Prints the manifest for building all indexes with: genescape build --manifest
+    """
+    print(f'obo = "{OBO}"')
+    for name, url in GENOMES:
+        gaf = url.split("/")[-1]
+        print()
+        print("[[genomes]]")
+        print(f'name = "{name}"')
+        print(f'url = "{url}"')
+        print(f'gaf = "obo/{gaf}"')
+        print(f'index = "obo/{name}.index.gz"')
+
+
 def main():
+    if "--manifest" in sys.argv:
+        manifest()
+        return
+
+    if os.path.isfile(OBO):
+        compile_obo()
+
     for name, url in GENOMES:
         idx = f"obo/{name}.index.gz"
         gaf = url.split("/")[-1]
@@ -1,9 +1,10 @@
-import difflib, sys, subprocess
+import difflib, gc, gzip, io, json, random, shutil, socket, sys, subprocess, threading, time, weakref
 import os
 
 import pytest, click
 from pathlib import Path
-from genescape import main
+from genescape import main, gs_binary, gs_cache, gs_graph, gs_index, gs_manifest, gs_obo, gs_ontology, gs_server,\
+    resources, utils
 from click.testing import CliRunner
 
 # Testing directory
@@ -27,6 +28,15 @@ def show_diff(exp, gen, cmd):
     fix = cmd.replace("/out/", "/files/")
     print(f"# Replace: genescape {fix}")
 
+@pytest.fixture(autouse=True)
+def storage(monkeypatch):
+    """
+    Keeps the files written by the tests out of the storage directory of the user.
+    """
+    get_storage_dir = resources.get_storage_dir
+    monkeypatch.setattr(resources, "get_storage_dir",
+                        lambda config: get_storage_dir(dict(config, store="test/out/store")))
+
 PARAMS = [
     ("test_genes_hs_1.txt", "out_test_genes_hs_1.csv", "annotate"),
     ("test_genes_hs_1.txt", "out_test_genes_hs_1_signal.csv", "annotate --mincov 1 --match signal"),
@@ -66,7 +76,9 @@ def test_genescape(inp_name, out_name, cmd):
         raise AssertionError(f"content mismatch: {out_name}")
 
 
-@pytest.mark.parametrize("cmd", ["build -s --idx src/genescape/data/human.index.gz", "annotate -t -o test/out/genescape.csv", "tree -t -o test/out/genescape.pdf"])
+@pytest.mark.parametrize("cmd", ["build -s --idx src/genescape/data/human.index.gz",
+                                 "build -b test/files/test_mini.obo -g test/files/test_mini.gaf -j 2 -i test/out/mini.index.gz",
+                                 "annotate -t -o test/out/genescape.csv", "tree -t -o test/out/genescape.pdf"])
 def test_run(cmd):
 
     full = f"{cmd}"
@@ -78,5 +90,630 @@ def test_run(cmd):
     # Check that the command completed correctly
     assert res.exit_code == 0
 
+def test_build_jobs():
+
+    runner = CliRunner()
+
+    # Free text columns may hold Unicode line separators.
+    gaf_path = Path("test/out") / "mini_separators.gaf"
+    gaf_path.write_text(read_file("test/files/test_mini.gaf").replace("\tdesc\t", "\tdesc\u2028a\tb\tc\x1cd\t"))
+
+    # The parallel parse of the GAF file must produce the same index.
+    for gaf in ("test/files/test_mini.gaf", gaf_path):
+        texts = []
+        for jobs in (1, 2):
+            idx_path = Path("test/out") / f"mini_jobs{jobs}.index.json"
+            res = runner.invoke(main.run, f"build -b test/files/test_mini.obo -g {gaf} -j {jobs} -i {idx_path}".split())
+            assert res.exit_code == 0
+            texts.append(read_file(idx_path))
+
+        assert texts[0] == texts[1]
+
+def test_propagation():
+
+    # Two genes annotated to the parents of GO:0043231, each parent reaches it through its own path.
+    gaf_path = Path("test/out") / "mini_shared.gaf"
+    row = read_file("test/files/test_mini.gaf").splitlines()[-1].split("\t")
+    lines = [read_file("test/files/test_mini.gaf")]
+    for symb, goid in (("GENEA", "GO:0043227"), ("GENEB", "GO:0043229")):
+        lines.append("\t".join(row[:2] + [symb, row[3], goid] + row[5:]) + "\n")
+    gaf_path.write_text("".join(lines))
+
+    idx_path = Path("test/out") / "mini_shared.index.gz"
+    runner = CliRunner()
+    res = runner.invoke(main.run, f"build -b test/files/test_mini.obo -g {gaf_path} -i {idx_path}".split())
+    assert res.exit_code == 0
+
+    idg = gs_graph.load_index_graph(idx_path)
+    run = gs_graph.Run(idg, targets=["CYP1A1", "SPTLC2", "SPHK2", "APP", "GENEA", "GENEB"])
+
+    # Both parents count the genes of the shared child and of its descendants.
+    shared = ["APP", "CYP1A1", "SPHK2", "SPTLC2"]
+    assert sorted(run.attrs["GO:0043231"].sources_all) == shared
+    assert sorted(run.attrs["GO:0043227"].sources_all) == sorted(shared + ["GENEA"])
+    assert sorted(run.attrs["GO:0043229"].sources_all) == sorted(shared + ["GENEB"])
+    assert run.attrs["GO:0043226"].src_all_len == 6
+    assert run.attrs["GO:0043229"].descendants == {"GO:0043229", "GO:0043231", "GO:0005634"}
+
+    # The labels show the counts.
+    text = run.as_pydot().to_string()
+    assert text.count("(5/6)") == 2
+    assert text.count("(4/6)") == 2
+
+def test_binary():
+
+    bin_path = Path("test/out") / "human.index.bin"
+
+    runner = CliRunner()
+
+    # Convert the bundled index into the binary format.
+    res = runner.invoke(main.run, f"build -f bin -c src/genescape/data/human.index.gz -i {bin_path}".split())
+    assert res.exit_code == 0
+
+    # The binary index must produce the same annotations.
+    inp_path = Path("test/files") / "test_genes_hs_1.txt"
+    exp_path = Path("test/files") / "out_test_genes_hs_1.csv"
+    gen_path = Path("test/out") / "out_binary_hs_1.csv"
+
+    res = runner.invoke(main.run, f"annotate -i {bin_path} -o {gen_path} {inp_path}".split())
+    assert res.exit_code == 0
+
+    assert read_file(exp_path) == read_file(gen_path)
+
+    # Writing over a mapped index replaces the file, the mapped copy stays readable.
+    new_path = Path("test/out") / "replaced.index.bin"
+    shutil.copy(bin_path, new_path)
+    idg = gs_index.IndexGraph(gs_index.read_index(new_path))
+    targets = read_file(inp_path).split()
+    before = gs_graph.Run(idg, targets=targets).as_csv()
+    res = runner.invoke(main.run, f"build -f bin -c src/genescape/data/ecoli.index.gz -i {new_path}".split())
+    assert res.exit_code == 0
+    assert gs_graph.Run(idg, targets=targets).as_csv() == before
+
+def test_sort_rows():
+
+    # Ties in coverage are ordered by GO term.
+    rows = [dict(Coverage=1, GO="GO:3"), dict(Coverage=2, GO="GO:2"), dict(Coverage=1, GO="GO:1")]
+    assert [row["GO"] for row in gs_graph.sort_rows(rows)] == ["GO:2", "GO:1", "GO:3"]
+
+    # The dataframe and the rows come out in the same order.
+    idg = gs_graph.load_index_graph("src/genescape/data/human.index.gz")
+    targets = read_file(Path("test/files") / "test_genes_hs_2.txt").split()
+    run = gs_graph.Run(idg, targets=targets)
+    assert run.as_df().to_dict("records") == run.as_rows()
+
+def test_build_mem():
+
+    obo_path = Path("test/files") / "test_mini.obo"
+    gaf_path = Path("test/files") / "test_mini.gaf"
+    idx_path = Path("test/out") / "mini.index.gz"
+    bin_path = Path("test/out") / "mini_mem.index.bin"
+
+    runner = CliRunner()
+
+    # A tiny memory budget forces many sorted runs.
+    res = runner.invoke(main.run, f"build -b {obo_path} -g {gaf_path} -i {idx_path}".split())
+    assert res.exit_code == 0
+    res = runner.invoke(main.run, f"build -b {obo_path} -g {gaf_path} -f bin --mem 0.001 -i {bin_path}".split())
+    assert res.exit_code == 0
+
+    # The out of core build must produce the same annotations.
+    inp_path = Path("test/out") / "mini_genes.txt"
+    inp_path.write_text("CYP1A1\nSPHK2\nSPTLC2\nSMPD3\nAPP\n")
+
+    for path in (idx_path, bin_path):
+        res = runner.invoke(main.run, f"annotate -i {path} -o {path}.csv {inp_path}".split())
+        assert res.exit_code == 0
+
+    assert read_file(f"{idx_path}.csv") == read_file(f"{bin_path}.csv")
+
+    # The out of core build parses the GAF file in a single job.
+    res = runner.invoke(main.run, f"build -b {obo_path} -g {gaf_path} -f bin --mem 1 -j 2 -i {bin_path}".split())
+    assert res.exit_code != 0
+
+def test_batch():
+
+    inp_path = Path("test/files") / "test_lists.gmt"
+    out_dir = Path("test/out") / "batch"
+
+    runner = CliRunner()
+
+    res = runner.invoke(main.run, f"batch -j 2 -d -o {out_dir} {inp_path}".split())
+    assert res.exit_code == 0
+
+    # Each list produces the same outputs as the single list commands.
+    for name in ("hs_1", "hs_2"):
+        for ext in ("csv", "dot"):
+            exp_path = Path("test/files") / f"out_test_genes_{name}.{ext}"
+            assert read_file(exp_path) == read_file(out_dir / f"{name}.{ext}")
+
+    # The summary keeps the input order.
+    lines = read_file(out_dir / "batch.csv").splitlines()
+    assert [line.split(",")[0] for line in lines] == ["name", "hs_1", "hs_2"]
+
+    # Long format lists stream into a single JSON lines file.
+    inp_path = Path("test/out") / "batch_long.csv"
+    genes = read_file(Path("test/files") / "test_genes_hs_1.txt").split()
+    inp_path.write_text("list_id,gene\n" + "".join(f"hs_1,{gene}\n" for gene in genes))
+
+    out_path = Path("test/out") / "batch.jsonl"
+    res = runner.invoke(main.run, f"batch -o {out_path} {inp_path}".split())
+    assert res.exit_code == 0
+
+    data = json.loads(read_file(out_path))
+    exp_path = Path("test/files") / "out_test_genes_hs_1.csv"
+    assert data["name"] == "hs_1"
+    assert len(data["terms"]) == len(read_file(exp_path).splitlines()) - 1
+
+    # Rows with more values than the header are rejected.
+    inp_path.write_text("hs_1\nSTAT1,TP53\n")
+    res = runner.invoke(main.run, f"batch -o {out_path} {inp_path}".split())
+    assert res.exit_code != 0
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+def test_daemon():
+
+    path = Path("test/out") / "genescape.sock"
+    if path.exists():
+        path.unlink()
+
+    server = gs_server.Server(str(path), gs_server.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        # The daemon produces the same output as the command line.
+        inp_path = Path("test/files") / "test_genes_hs_1.txt"
+        exp_path = Path("test/files") / "out_test_genes_hs_1.csv"
+        gen_path = Path("test/out") / "out_daemon_hs_1.csv"
+
+        text = io.StringIO()
+        head = gs_server.forward(str(path), text, cmd=gs_server.CMD_ANNOTATE, idx="src/genescape/data/human.index.gz",
+                                 targets=read_file(inp_path).split())
+        assert head["status"] == "ok"
+        assert text.getvalue() == read_file(exp_path)
+
+        runner = CliRunner()
+        res = runner.invoke(main.run, f"annotate -o {gen_path} {inp_path}".split(),
+                            env={gs_server.SOCKET_ENV: str(path)})
+        assert res.exit_code == 0
+        assert read_file(gen_path) == read_file(exp_path)
+
+        # Invalid indexes are reported to the client.
+        bad_path = Path("test/out") / "bad.index.bin"
+        text = json.dumps(dict(version=-1)).encode("utf-8")
+        bad_path.write_bytes(gs_binary.PREAMBLE.pack(gs_binary.MAGIC, gs_binary.PREAMBLE.size, len(text)) + text)
+        for idx in ("test/out/nope.index.gz", bad_path):
+            with pytest.raises(SystemExit):
+                gs_server.forward(str(path), io.StringIO(), cmd=gs_server.CMD_ANNOTATE, idx=idx, targets=["SPHK2"])
+    finally:
+        server.shutdown()
+        server.server_close()
+        path.unlink()
+
+    # Without a daemon the requests run in process.
+    assert gs_server.forward(str(path), io.StringIO(), cmd=gs_server.CMD_ANNOTATE, idx="", targets=[]) is None
+
+# The time budget to import the command line, in seconds.
+STARTUP_BUDGET = 0.5
+
+def test_startup():
+
+    # The heavy dependencies are imported by the commands that need them.
+    code = "import sys; from genescape import main, gs_graph; print(' '.join(sys.modules))"
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    assert res.returncode == 0
+
+    modules = set(res.stdout.split())
+    for name in ("pandas", "pydot", "networkx", "shiny"):
+        assert name not in modules
+
+    # The cumulative import time of the command line, in microseconds.
+    times = dict()
+    for line in res.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            times[name.strip()] = cumulative.strip()
+    assert int(times["genescape.main"]) / 1e6 < STARTUP_BUDGET
+
+def test_build_cache():
+
+    obo_path = Path("test/files") / "test_mini.obo"
+    gaf_path = Path("test/files") / "test_mini.gaf"
+
+    runner = CliRunner()
+
+    # Parse the ontology, then compile it and load it from the cache.
+    paths = []
+    for flag in ("--nocache", "", ""):
+        idx_path = Path("test/out") / f"mini_cache{len(paths)}.index.json"
+        res = runner.invoke(main.run, f"build -b {obo_path} -g {gaf_path} -i {idx_path} {flag}".split())
+        assert res.exit_code == 0
+        paths.append(idx_path)
+
+    # The compiled ontology must produce the same index.
+    assert read_file(paths[0]) == read_file(paths[1]) == read_file(paths[2])
+
+    # The compiled ontology is kept in the storage directory of the tests.
+    assert list(Path("test/out/store").glob(f"*/{gs_obo.CACHE_DIR}/*.obo.bin"))
+
+def test_build_manifest(caplog, monkeypatch):
+
+    runner = CliRunner()
+
+    # Build the indexes listed in the manifest in parallel.
+    res = runner.invoke(main.run, "build -m test/files/test_manifest.toml -j 2".split())
+    assert res.exit_code == 0
+
+    # Both indexes must produce the same annotations.
+    inp_path = Path("test/out") / "manifest_genes.txt"
+    inp_path.write_text("CYP1A1\nSPHK2\nSPTLC2\nSMPD3\nAPP\n")
+
+    outputs = []
+    for name in ("manifest_mini1.index.gz", "manifest_mini2.index.bin"):
+        path = Path("test/out") / name
+        res = runner.invoke(main.run, f"annotate -i {path} -o {path}.csv {inp_path}".split())
+        assert res.exit_code == 0
+        outputs.append(read_file(f"{path}.csv"))
+
+    assert outputs[0] == outputs[1]
+
+    # A build stopped by an error is reported in the summary, the other builds complete.
+    build_index = gs_index.build_index
+
+    def build(gaf_fname, **kwargs):
+        if gaf_fname == "missing.gaf":
+            utils.stop(f"file not found: {gaf_fname}")
+        return build_index(gaf_fname=gaf_fname, **kwargs)
+
+    monkeypatch.setattr(gs_index, "build_index", build)
+
+    out_path = Path("test/out") / "manifest_mini3.index.gz"
+    if out_path.exists():
+        out_path.unlink()
+    genomes = [dict(name="missing", gaf="missing.gaf", index="test/out/missing.index.gz"),
+               dict(name="mini3", gaf="test/files/test_mini.gaf", index=str(out_path))]
+    with pytest.raises(SystemExit):
+        gs_manifest.build_all(genomes, obo_fname="test/files/test_mini.obo", cache_dir="test/out", jobs=2)
+    assert out_path.exists()
+    assert "failed builds: missing" in caplog.text
+
+def test_ontology_graph():
+    import networkx as nx
+
+    # The networkx graph of the mini ontology, built as the index did before.
+    idx = gs_obo.read_obo("test/files/test_mini.obo", idx=gs_index.Index())
+    nodes = [row for row in idx.obo.values() if not row.get("is_obsolete")]
+    expected = nx.DiGraph()
+    expected.add_nodes_from(row["id"] for row in nodes)
+    expected.add_edges_from((parent, row["id"]) for row in nodes for parent in row.get("is_a", []))
+
+    graph = gs_ontology.OntoGraph.from_obo(idx.obo)
+
+    # The same nodes in the same order, the same edges.
+    assert list(graph) == list(expected)
+    assert graph.number_of_nodes() == expected.number_of_nodes()
+    assert graph.number_of_edges() == expected.number_of_edges()
+    assert set(graph.to_networkx().edges()) == set(expected.edges())
+
+    # The adjacency, the degrees and the closures agree.
+    for goid in expected:
+        assert sorted(graph.successors(goid)) == sorted(expected.successors(goid))
+        assert sorted(graph.predecessors(goid)) == sorted(expected.predecessors(goid))
+        assert graph.in_degree(goid) == expected.in_degree(goid)
+        assert graph.out_degree(goid) == expected.out_degree(goid)
+        assert graph.ancestors(goid) == nx.ancestors(expected, goid)
+        assert graph.descendants(goid) == nx.descendants(expected, goid)
+
+    # Parents come before their children, the depth is the longest path from a root.
+    order = {goid: pos for pos, goid in enumerate(graph.topological_sort())}
+    assert sorted(order) == sorted(expected)
+    assert all(order[parent] < order[child] for parent, child in expected.edges())
+    depths = dict()
+    for goid in nx.topological_sort(expected):
+        depths[goid] = max((depths[parent] + 1 for parent in expected.predecessors(goid)), default=0)
+        assert graph.depth(goid) == depths[goid]
+
+def test_closure():
+
+    obo_path = Path("test/files") / "test_mini.obo"
+    gaf_path = Path("test/files") / "test_mini.gaf"
+    bin_path = Path("test/out") / "mini_closure.index.bin"
+
+    runner = CliRunner()
+    res = runner.invoke(main.run, f"build -b {obo_path} -g {gaf_path} -f bin -i {bin_path}".split())
+    assert res.exit_code == 0
+
+    # A graph built from the ontology computes its closure on first use.
+    idx = gs_obo.read_obo(obo_path, idx=gs_index.Index())
+    graph = gs_ontology.OntoGraph.from_obo(idx.obo)
+    assert graph.anc_ptr is None
+    rows = [sorted(graph.walk([pos], graph.parents)) for pos in range(graph.size)]
+    assert [list(graph.ancestor_indices(pos)) for pos in range(graph.size)] == rows
+    assert graph.anc_ptr is not None
+
+    # The binary index stores the same closure, the graph reads it without computing it.
+    store = gs_index.read_index(bin_path).store
+    assert store.has("anc_ptr") and store.has("anc_idx")
+    assert list(store.section("anc_ptr"))[:graph.size + 1] == list(graph.anc_ptr)
+    assert list(store.section("anc_idx")) == list(graph.anc_idx)
+
+    stored = gs_ontology.OntoGraph.from_store(store)
+    assert stored.anc_ptr is not None
+    assert [list(stored.ancestor_indices(pos)) for pos in range(graph.size)] == rows
+
+def test_shared_ontology():
+
+    # Indexes of the same ontology share one graph, the counts are their own.
+    human = gs_graph.load_index_graph("src/genescape/data/human.index.gz")
+    mouse = gs_graph.load_index_graph("src/genescape/data/mouse.index.gz")
+
+    assert human.graph.parent_idx is mouse.graph.parent_idx
+    assert human.graph.counts is not mouse.graph.counts
+
+def test_result_cache():
+
+    cache = gs_cache.LRUCache(maxsize=2, maxbytes=100)
+
+    cache.put("a", 1, nbytes=10)
+    cache.put("b", 2, nbytes=10)
+    assert cache.get("a") == 1
+
+    # The least recently used entry is evicted first.
+    cache.put("c", 3, nbytes=10)
+    assert "b" not in cache and "a" in cache
+
+    # Entries over the memory limit evict the others.
+    cache.put("d", 4, nbytes=95)
+    assert list(cache.data) == ["d"]
+
+    assert cache.get("x") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 3)
+
+    # Queries normalize the targets.
+    fname = "src/genescape/data/human.index.gz"
+    key1 = gs_cache.query_key(fname, ["sphk2", "CYP1A1"], mincount=2)
+    key2 = gs_cache.query_key(fname, ["CYP1A1", "SPHK2", "Sphk2"], mincount=2)
+    assert key1 == key2
+
+def test_index_cache():
+
+    cache = gs_cache.IndexCache(maxbytes=100)
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.1)
+        return "value"
+
+    # Concurrent requests for the same key share a single load.
+    threads = [threading.Thread(target=cache.get, args=("a", load), kwargs=dict(sizeof=lambda x: 60))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+
+    # Entries over the budget evict the least recently used ones.
+    cache.get("b", lambda: "other", sizeof=lambda x: 60)
+    assert "a" not in cache and "b" in cache
+
+    stats = cache.stats()
+    assert (stats["loads"], stats["waits"], stats["evictions"]) == (2, 3, 1)
+    assert stats["entries"]["b"]["nbytes"] == 60
+
+    # The same file loads once, whatever the form of the path.
+    idg1 = gs_graph.load_index_graph("src/genescape/data/human.index.gz")
+    idg2 = gs_graph.load_index_graph(Path("src/genescape/data/human.index.gz").resolve())
+    assert idg1 is idg2
+
+def test_lazy_resources():
+
+    # The resources are located on first use, installed files are read in place.
+    config = resources.get_config()
+    config["store"] = "test/out/store"
+    resources.reset_dir(config)
+    res = resources.init(config)
+    assert not res.paths
+    assert res.TEST_GENES.is_file() and list(res.paths) == ["test_genes.txt"]
+    assert not resources.get_storage_dir(config).exists()
+
+    # Writable copies go to the storage directory.
+    path = resources.get_path(package="genescape.data", target="test_genes.txt", config=config, writable=True)
+    assert path.parent == resources.get_storage_dir(config)
+    assert read_file(path) == read_file(res.TEST_GENES)
+
+def test_shared_index():
+
+    # A JSON index is published once as a binary index.
+    fname = "src/genescape/data/ecoli.index.gz"
+    shared_dir = Path("test/out") / "shared"
+    path = gs_index.publish(fname, shared_dir)
+    assert gs_binary.is_binary(path)
+    assert gs_index.publish(fname, shared_dir) == path
+
+    # The published index gives the same results.
+    idg = gs_graph.load_index_graph(fname)
+    targets = gs_graph.random_symbols(idg, N=20)
+    shared = gs_index.IndexGraph(gs_index.read_index(path))
+    assert gs_graph.Run(shared, targets=targets).as_csv() == gs_graph.Run(idg, targets=targets).as_csv()
+
+def test_reload_index():
+
+    # A copy of an index that is changed while loaded.
+    fname = Path("test/out/watch/ecoli.index.gz")
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname.write_bytes(Path("src/genescape/data/ecoli.index.gz").read_bytes())
+
+    old = gs_graph.load_index_graph(fname)
+    watcher = gs_index.Watcher([fname])
+    assert watcher.check() == []
+
+    # The changed file is reloaded once it settles, the old index stays usable.
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert watcher.check() == []
+    assert watcher.check() == [fname]
+
+    new = gs_graph.load_index_graph(fname)
+    assert new is not old and new.identity == gs_cache.index_identity(fname)
+    targets = gs_graph.random_symbols(old, N=10)
+    assert gs_graph.Run(old, targets=targets).as_csv() == gs_graph.Run(new, targets=targets).as_csv()
+    assert watcher.check() == []
+
+def test_reload_release():
+
+    def write_release(fname, version):
+        with gzip.open("src/genescape/data/ecoli.index.gz", "rt") as fp:
+            data = json.load(fp)
+        data[gs_index.Index.INFO_KEY]["data-version"] = version
+        with gzip.open(fname, "wt") as fp:
+            json.dump(data, fp)
+
+    # An index of an older ontology release.
+    fname = Path("test/out/watch/release.index.gz")
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    write_release(fname, "releases/old")
+    idg = gs_graph.load_index_graph(fname)
+    graph = weakref.ref(idg.graph.base)
+    assert graph() in gs_ontology.REGISTRY.values()
+
+    # The graph of the old release is released with the last index that uses it.
+    write_release(fname, "releases/new")
+    new = gs_index.reload_index_graph(fname)
+    del idg
+    gc.collect()
+    assert graph() is None
+    assert new.graph.base in gs_ontology.REGISTRY.values()
+
+def test_ready(monkeypatch):
+    from starlette.testclient import TestClient
+
+    # The app sets the shared directory of the indexes when imported.
+    monkeypatch.setattr(gs_index, "SHARED_DIR", gs_index.SHARED_DIR)
+    from genescape.shiny.tree import app
+
+    # The startup load waits until released.
+    release = threading.Event()
+    load_index_graph = gs_graph.load_index_graph
+
+    def load(fname):
+        release.wait()
+        return load_index_graph(fname)
+
+    monkeypatch.setattr(gs_graph, "load_index_graph", load)
+    monkeypatch.setattr(app, "WARMUP", ["ecoli"])
+    monkeypatch.setattr(app, "WARMING", dict())
+
+    client = TestClient(app.app)
+    app.warm_up(app.WARMUP)
+    res = client.get("/ready")
+    assert res.status_code == 503 and res.json()["indexes"] == dict(ecoli="loading")
+
+    # Ready once the index is loaded.
+    release.set()
+    app.WARMING["ecoli"].result()
+    res = client.get("/ready")
+    assert res.status_code == 200 and res.json()["ready"]
+
+    # An index evicted from the cache is no longer ready.
+    gs_index.INDEXES.pop(str(Path(app.res.find_index("ecoli")).resolve()))
+    res = client.get("/ready")
+    assert res.status_code == 503 and res.json()["indexes"] == dict(ecoli="evicted")
+
+def test_progress(monkeypatch):
+
+    # The app sets the shared directory of the indexes when imported.
+    monkeypatch.setattr(gs_index, "SHARED_DIR", gs_index.SHARED_DIR)
+    from genescape.shiny.tree import app
+
+    calls = []
+
+    def progress(stage, fraction):
+        calls.append((stage, fraction))
+
+    def current():
+        return True
+
+    idx_fname = "src/genescape/data/human.index.gz"
+    targets = read_file(Path("test/files") / "test_genes_hs_1.txt").split()
+    monkeypatch.setattr(app, "RESULTS", gs_cache.LRUCache(maxsize=4))
+    monkeypatch.setattr(app, "SESSIONS", gs_cache.LRUCache(maxsize=4))
+
+    # The stages are reported in order, the fractions increase up to the end of the pipeline.
+    app.compute(idx_fname, targets=targets, root=utils.NS_ALL, coverage=0, pattern="", current=current,
+                progress=progress)
+    stages = [stage for stage, _ in calls]
+    fractions = [fraction for _, fraction in calls]
+    assert stages[0] == gs_graph.STAGE_INDEX and stages[-1] == gs_graph.STAGE_OUTPUT
+    assert set(stages) == set(gs_graph.STAGES)
+    assert all(0 < fraction <= 1 for fraction in fractions)
+    assert fractions == sorted(fractions) and fractions[-1] == 1.0
+
+    # A cached result completes the progress as well.
+    calls.clear()
+    app.compute(idx_fname, targets=targets, root=utils.NS_ALL, coverage=0, pattern="", current=current,
+                progress=progress)
+    assert calls[-1] == (gs_graph.STAGE_OUTPUT, 1.0)
+    assert [fraction for _, fraction in calls] == sorted(fraction for _, fraction in calls)
+
+def test_session():
+
+    # Runs derived from a session match the runs from scratch.
+    idg = gs_graph.load_index_graph("src/genescape/data/human.index.gz")
+    random.seed(1)
+    targets = gs_graph.random_symbols(idg, N=50) + ["GO:0005737", "NOPE"]
+    session = gs_graph.Session(idg, targets=targets)
+
+    for root, mincount, pattern in [(utils.NS_ALL, 1, ""), ("BP", 2, "signal"), (utils.NS_ALL, 1, "((")]:
+        run = session.run(root=root, mincount=mincount, pattern=pattern)
+        fresh = gs_graph.Run(idg, targets=targets, root=root, mincount=mincount, pattern=pattern)
+        assert run.errors == fresh.errors
+        assert run.as_df().equals(fresh.as_df())
+
+    # Repeated filters return the same run.
+    assert session.run(mincount=1) is session.run(mincount=1)
+
+    # Sessions may keep no runs, their size bounds the session caches.
+    bare = gs_graph.Session(idg, targets=targets, runs=0)
+    bare.run(mincount=1)
+    assert len(bare.runs) == 0
+    cache = gs_cache.LRUCache(maxbytes=bare.nbytes())
+    cache.put("a", bare, nbytes=bare.nbytes())
+    cache.put("b", session, nbytes=session.nbytes())
+    assert "a" not in cache and "b" in cache
+
+    # The fused pass matches the separate estimate and subgraph.
+    coverage = gs_graph.estimate(idg, targets=targets, root="BP")
+    run, cover = gs_graph.annotate(idg, targets=targets, root="BP")
+    assert cover == coverage
+    assert run.as_df().equals(gs_graph.subgraph(idg, targets=targets, root="BP", coverage=coverage).as_df())
+
+def test_max_nodes(caplog):
+
+    # The estimated coverage gives the largest tree within the budget.
+    idg = gs_graph.load_index_graph("src/genescape/data/human.index.gz")
+    random.seed(3)
+    targets = gs_graph.random_symbols(idg, N=200)
+
+    # The tree fits the budget, the next lower cutoff does not.
+    run, coverage = gs_graph.annotate(idg, targets=targets, max_nodes=100)
+    assert run.tree.number_of_nodes() <= 100
+    lower = [len(run.go2inp[goid]) for goid in run.session.select() if len(run.go2inp[goid]) < coverage]
+    assert gs_graph.subgraph(idg, targets=targets, coverage=max(lower)).tree.number_of_nodes() > 100
+
+    run, coverage = gs_graph.annotate(idg, targets=targets, max_edges=100)
+    assert run.tree.number_of_edges() <= 100
+    lower = [len(run.go2inp[goid]) for goid in run.session.select() if len(run.go2inp[goid]) < coverage]
+    assert gs_graph.subgraph(idg, targets=targets, coverage=max(lower)).tree.number_of_edges() > 100
+    assert "over the budget" not in caplog.text
+
+    # No cutoff fits a budget below the size of the smallest tree, the tree is reported.
+    run, coverage = gs_graph.annotate(idg, targets=targets, max_nodes=1)
+    nodes, edges = run.tree.number_of_nodes(), run.tree.number_of_edges()
+    assert nodes > 1
+    assert f"the tree has {nodes} nodes, {edges} edges, over the budget" in caplog.text
+
 if __name__ == "__main__":
     pytest.main([__file__, '--verbose'])